@@ -1,25 +1,35 @@
-import torch
 import sys
-import moviepy
 import os
+import base64
+import subprocess
 import requests
 import json
 import pytz
 import collections
 import re
+import hashlib
+import hmac
+import unicodedata
+import sqlite3
+import threading
+import queue
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from time import monotonic, sleep
+import tempfile
+import shutil
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
-from datetime import datetime, time
+from datetime import datetime, time, timezone, timedelta
 from together import Together
-from pytrends.request import TrendReq
-from pydub.effects import normalize
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip
-from moviepy.video.fx import fadein, fadeout
-from PIL import Image, ImageDraw, ImageFont
-from bark import generate_audio
-from scipy.io.wavfile import write
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 from pydub import AudioSegment, effects
-from moviepy.editor import VideoFileClip, TextClip, CompositeVideoClip
 from dotenv import load_dotenv
+from flask import Flask, jsonify, request, send_file
+
+# torch و bark سنگین هستند و فقط در مرحله‌ای که به آن‌ها نیاز دارد بارگذاری می‌شوند
 
 SHORTS_DURATION=59
 LONG_VIDEO_DURATION=600
@@ -67,6 +77,93 @@ SHORT_VIDEO_FILE = "short_video.mp4"  # ویدیوی Shorts
 MAX_LONG_UPLOADS = 1  # فقط 1 ویدیوی بلند در روز
 MAX_SHORTS_UPLOADS = 1  # فقط 1 Shorts در روز
 
+# کش ترندها: تا TTL ثانیه همان نتیجه برگردانده می‌شود و بعد از آن در پس‌زمینه تازه می‌شود
+TREND_CACHE_FILE = os.getenv("TREND_CACHE_FILE", "trend_cache.json")
+TREND_CACHE_TTL = int(os.getenv("TREND_CACHE_TTL", "3600"))
+
+# جمع‌آوری ترندهای جهانی یوتیوب (کدهای منطقه و شناسه‌ی دسته‌بندی‌ها با کاما جدا می‌شوند)
+TREND_REGIONS = [r.strip() for r in os.getenv("TREND_REGIONS", "US,GB,CA,AU,IN").split(",") if r.strip()]
+TREND_CATEGORIES = [c.strip() for c in os.getenv("TREND_CATEGORIES", "20,28,27").split(",") if c.strip()]
+TREND_MAX_ITEMS = 200  # سقف چارت mostPopular
+TREND_QUOTA_BUDGET = int(os.getenv("TREND_QUOTA_BUDGET", "100"))  # واحد سهمیه در هر اجرا
+TREND_FETCH_WORKERS = 8
+
+def _read_json_file(path, default):
+    """Load a JSON state file, falling back to `default` if it is missing or corrupt."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def _write_json_atomic(path, data, mode=0o666):
+    """
+    Write a JSON state file via a temp file + rename so readers never see a partial file.
+    mode is applied when the temp file is created (subject to the umask), e.g. 0o600 for secrets.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# سهمیه‌ی روزانه‌ی YouTube Data API؛ در نیمه‌شب به وقت Pacific صفر می‌شود
+YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))
+QUOTA_USAGE_FILE = "quota_usage.json"
+PACIFIC = pytz.timezone("America/Los_Angeles")
+YOUTUBE_QUOTA_COSTS = {
+    "channels.list": 1,
+    "playlistItems.list": 1,
+    "videos.list": 1,
+    "search.list": 100,
+    "videos.insert": 1600,
+    "videos.update": 50,
+    "thumbnails.set": 50
+}
+
+_quota_lock = threading.Lock()
+
+def _quota_day():
+    return datetime.now(PACIFIC).strftime("%Y-%m-%d")
+
+def _load_quota_usage():
+    usage = _read_json_file(QUOTA_USAGE_FILE, {})
+    if usage.get("date") != _quota_day():
+        usage = {"date": _quota_day(), "used": 0, "calls": {}}
+    return usage
+
+def charge_youtube_quota(api_method, units=None):
+    """ثبت هزینه‌ی یک فراخوانی؛ اگر از بودجه‌ی روزانه بیشتر شود، False برمی‌گرداند و چیزی ثبت نمی‌شود."""
+    units = YOUTUBE_QUOTA_COSTS.get(api_method, 1) if units is None else units
+    with _quota_lock:
+        usage = _load_quota_usage()
+        if usage["used"] + units > YOUTUBE_DAILY_QUOTA:
+            print(f"❌ YouTube quota budget exhausted: {api_method} needs {units} units, "
+                  f"{YOUTUBE_DAILY_QUOTA - usage['used']} left today.")
+            return False
+        usage["used"] += units
+        usage["calls"][api_method] = usage["calls"].get(api_method, 0) + 1
+        _write_json_atomic(QUOTA_USAGE_FILE, usage)
+    return True
+
+def get_quota_usage():
+    """ شمارنده‌های مصرف امروز: واحد مصرف‌شده، باقی‌مانده و تعداد فراخوانی هر متد """
+    with _quota_lock:
+        usage = _load_quota_usage()
+    return {**usage, "budget": YOUTUBE_DAILY_QUOTA, "remaining": YOUTUBE_DAILY_QUOTA - usage["used"]}
+
+def youtube_request(http_method, api_method, url, units=None, **kwargs):
+    """
+    همه‌ی درخواست‌های YouTube Data API از این تابع عبور می‌کنند تا هزینه‌ی سهمیه ثبت شود.
+    اگر بودجه کافی نباشد، درخواستی ارسال نمی‌شود و None برگردانده می‌شود.
+    """
+    if not charge_youtube_quota(api_method, units):
+        return None
+    kwargs.setdefault("timeout", 30)
+    return requests.request(http_method, url, **kwargs)
+
 def fetch_google_trends():
     """Fetch trending topics from Google Trends."""
     url = "https://trends.google.com/trends/api/dailytrends"
@@ -102,6 +199,41 @@ def fetch_google_trends():
         print(f"❌ Request failed: {e}")
         return []
 
+def _parse_trending_video(video, rank, region_code):
+    """Turn one videos.list item into a trend dict, or None if it is not popular enough."""
+    try:
+        title = video["snippet"]["title"]
+        description = video["snippet"]["description"]
+        channel = video["snippet"]["channelTitle"]
+        video_id = video["id"]
+        view_count = int(video["statistics"].get("viewCount", 0))
+        like_count = int(video["statistics"].get("likeCount", 0))
+        thumbnail = video["snippet"]["thumbnails"]["high"]["url"]
+    except KeyError as e:
+        print(f"⚠️ Missing key {e} for video: {video.get('id', 'Unknown')}")
+        return None
+
+    # مقیاس محبوبیت بر اساس بازدید و لایک (بین ۰ تا ۱۰۰)
+    popularity = min(100, (view_count // 10000) + (like_count // 500))
+
+    # فقط ویدیوهای با محبوبیت بالا در نظر گرفته شوند
+    if popularity < 10:
+        return None
+
+    return {
+        "rank": rank,
+        "title": title,
+        "description": description,
+        "channel": channel,
+        "video_id": video_id,
+        "view_count": view_count,
+        "like_count": like_count,
+        "popularity": popularity,
+        "thumbnail": thumbnail,
+        "region": region_code,
+        "source": "YouTube"
+    }
+
 def fetch_youtube_trending(region_code="US", max_results=10):
     if not YOUTUBE_API_KEY:
         print("❌ Error: YouTube API Key is missing!")
@@ -117,7 +249,9 @@ def fetch_youtube_trending(region_code="US", max_results=10):
     }
 
     try:
-        response = requests.get(url, params=params)
+        response = youtube_request("GET", "videos.list", url, params=params)
+        if response is None:
+            return []
         response.raise_for_status()
         trending_videos = response.json().get("items", [])
     except requests.exceptions.RequestException as e:
@@ -126,45 +260,123 @@ def fetch_youtube_trending(region_code="US", max_results=10):
 
     trending_topics = []
     for rank, video in enumerate(trending_videos, start=1):
+        trend = _parse_trending_video(video, rank, region_code)
+        if trend:
+            trending_topics.append(trend)
+
+    if not trending_topics:
+        print("⚠ No trending videos found with enough popularity.")
+
+    return trending_topics
+
+def _fetch_trending_chart(region_code, category_id, max_items, charge_quota):
+    """ دنبال کردن nextPageToken در یک چارت mostPopular (حداکثر ۲۰۰ آیتم) """
+    url = "https://www.googleapis.com/youtube/v3/videos"
+    items = []
+    page_token = None
+
+    while len(items) < max_items:
+        # هر صفحه از videos.list یک واحد سهمیه مصرف می‌کند
+        if not charge_quota(1):
+            print(f"⚠ Trend quota budget exhausted, stopping {region_code}/{category_id or 'all'} early.")
+            break
+
+        params = {
+            "part": "snippet,statistics",
+            "chart": "mostPopular",
+            "regionCode": region_code,
+            "maxResults": min(50, max_items - len(items)),
+            "key": YOUTUBE_API_KEY
+        }
+        if category_id:
+            params["videoCategoryId"] = category_id
+        if page_token:
+            params["pageToken"] = page_token
+
         try:
-            title = video["snippet"]["title"]
-            description = video["snippet"]["description"]
-            channel = video["snippet"]["channelTitle"]
-            video_id = video["id"]
-            view_count = int(video["statistics"].get("viewCount", 0))
-            like_count = int(video["statistics"].get("likeCount", 0))
-            thumbnail = video["snippet"]["thumbnails"]["high"]["url"]
-
-            # مقیاس محبوبیت بر اساس بازدید و لایک (بین ۰ تا ۱۰۰)
-            popularity = min(100, (view_count // 10000) + (like_count // 500))
-
-            # فقط ویدیوهای با محبوبیت بالا در نظر گرفته شوند
-            if popularity >= 10:
-                trending_topics.append({
-                    "rank": rank,
-                    "title": title,
-                    "description": description,
-                    "channel": channel,
-                    "video_id": video_id,
-                    "view_count": view_count,
-                    "like_count": like_count,
-                    "popularity": popularity,
-                    "thumbnail": thumbnail,
-                    "region": region_code
-                })
-        except KeyError as e:
-            print(f"⚠️ Missing key {e} for video: {video.get('id', 'Unknown')}")
+            response = youtube_request("GET", "videos.list", url, params=params, timeout=10)
+            if response is None:
+                break
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"❌ Request failed for {region_code}/{category_id or 'all'}: {e}")
+            break
+
+        data = response.json()
+        items.extend(data.get("items", []))
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            break
+
+    return items
+
+def fetch_global_youtube_trending(regions=None, categories=None, max_items=TREND_MAX_ITEMS, quota_budget=TREND_QUOTA_BUDGET):
+    """
+    دریافت همزمان چارت‌های ترند برای چند منطقه و دسته‌بندی، با صفحه‌بندی کامل
+    و حذف موارد تکراری. مصرف سهمیه در هر اجرا به quota_budget محدود است.
+    """
+    if not YOUTUBE_API_KEY:
+        print("❌ Error: YouTube API Key is missing!")
+        return []
+
+    regions = regions or TREND_REGIONS
+    categories = categories or TREND_CATEGORIES or [None]
+    charts = [(region_code, category_id) for region_code in regions for category_id in categories]
+    if not charts:
+        print("⚠ No trend regions configured.")
+        return []
+
+    quota_lock = threading.Lock()
+    quota_used = [0]
+
+    def charge_quota(units):
+        with quota_lock:
+            if quota_used[0] + units > quota_budget:
+                return False
+            quota_used[0] += units
+            return True
+
+    merged = {}
+    with ThreadPoolExecutor(max_workers=min(TREND_FETCH_WORKERS, len(charts))) as executor:
+        futures = {
+            executor.submit(_fetch_trending_chart, region_code, category_id, max_items, charge_quota): region_code
+            for region_code, category_id in charts
+        }
+        for future in as_completed(futures):
+            region_code = futures[future]
+            for rank, video in enumerate(future.result(), start=1):
+                trend = _parse_trending_video(video, rank, region_code)
+                if not trend:
+                    continue
+
+                existing = merged.get(trend["video_id"])
+                if existing is None:
+                    trend["regions"] = [region_code]
+                    merged[trend["video_id"]] = trend
+                    continue
+
+                # همان ویدیو در چند منطقه ترند است: بهترین رتبه را نگه می‌داریم
+                if region_code not in existing["regions"]:
+                    existing["regions"].append(region_code)
+                if rank < existing["rank"]:
+                    existing["rank"] = rank
+                    existing["region"] = region_code
+
+    trending_topics = sorted(merged.values(), key=lambda t: (-len(t["regions"]), -t["popularity"], t["rank"]))
+
+    print(f"✅ Collected {len(trending_topics)} unique trending videos from {len(charts)} charts "
+          f"({quota_used[0]}/{quota_budget} quota units).")
 
     if not trending_topics:
         print("⚠ No trending videos found with enough popularity.")
 
     return trending_topics
 
-def fetch_all_trends(region_code="US"):
+def _collect_trends(region_code=None):
     """ دریافت و ترکیب داده‌های ترند از یوتیوب و گوگل ترندز """
 
     print("🔍 Fetching YouTube Trends...")
-    youtube_trends = fetch_youtube_trending(region_code)
+    youtube_trends = fetch_global_youtube_trending(regions=[region_code] if region_code else None)
 
     print("🔍 Fetching Google Trends...")
     google_trends = fetch_google_trends()
@@ -177,25 +389,77 @@ def fetch_all_trends(region_code="US"):
     
     return all_trends
 
-# فراخوانی تابع برای گرفتن ترندها
-trends = fetch_all_trends(region_code="US")
-for trend in trends:
-    print(trend)
+_trend_cache = {}  # region_code -> {"fetched_at": ..., "trends": [...]}
+_trend_cache_lock = threading.Lock()
+_trend_refreshing = set()
+
+def _get_trend_snapshot(region_code):
+    region_code = region_code or "global"
+    with _trend_cache_lock:
+        snapshot = _trend_cache.get(region_code)
+        if snapshot is None:
+            snapshot = _read_json_file(TREND_CACHE_FILE, {}).get(region_code)
+            if snapshot:
+                _trend_cache[region_code] = snapshot
+        return snapshot
+
+def _store_trend_snapshot(region_code, trends):
+    region_code = region_code or "global"
+    snapshot = {"fetched_at": datetime.now(timezone.utc).timestamp(), "trends": trends}
+    with _trend_cache_lock:
+        _trend_cache[region_code] = snapshot
+        snapshots = _read_json_file(TREND_CACHE_FILE, {})
+        snapshots[region_code] = snapshot
+        try:
+            _write_json_atomic(TREND_CACHE_FILE, snapshots)
+        except OSError as e:
+            print(f"⚠ Could not save trend cache: {e}")
+    return snapshot
+
+def _refresh_trends(region_code):
+    """Fetch fresh trends and replace the cached snapshot (empty results are not cached)."""
+    try:
+        trends = _collect_trends(region_code)
+        if trends:
+            _store_trend_snapshot(region_code, trends)
+        return trends
+    finally:
+        with _trend_cache_lock:
+            _trend_refreshing.discard(region_code)
+
+def fetch_all_trends(region_code=None, max_age=None, use_cache=True):
+    """
+    ترندها را از کش برمی‌گرداند. اگر کش منقضی شده باشد، نسخه‌ی قدیمی فوراً برگردانده می‌شود
+    و به‌روزرسانی در یک thread پس‌زمینه انجام می‌شود (stale-while-revalidate).
+    بدون region_code، ترندهای همه‌ی مناطق TREND_REGIONS جمع‌آوری می‌شوند.
+    """
+    ttl = TREND_CACHE_TTL if max_age is None else max_age
+    snapshot = _get_trend_snapshot(region_code) if use_cache else None
 
-def select_best_trending_topic(trends):
-    """ انتخاب بهترین موضوع ترند شده از لیست یوتیوب و ردیت، بر اساس تعداد تکرار و محبوبیت """
+    if not snapshot:
+        with _trend_cache_lock:
+            _trend_refreshing.add(region_code)
+        return _refresh_trends(region_code)
 
-    if not trends or not isinstance(trends, list):
-        print("❌ No trending topics found or invalid format.")
-        return None
+    age = datetime.now(timezone.utc).timestamp() - snapshot["fetched_at"]
+    if age <= ttl:
+        print(f"⚡ Using cached trends for {region_code or 'all regions'} ({int(age)}s old).")
+        return snapshot["trends"]
 
-    # ✅ فیلتر داده‌های نامعتبر (باید حداقل 'title' و 'source' داشته باشند)
-    valid_trends = [t for t in trends if isinstance(t, dict) and "title" in t and "source" in t]
+    with _trend_cache_lock:
+        start_refresh = region_code not in _trend_refreshing
+        _trend_refreshing.add(region_code)
 
-    if not valid_trends:
-        print("❌ No valid trending topics found.")
-        return None
+    if start_refresh:
+        print(f"🔄 Cached trends for {region_code or 'all regions'} are stale ({int(age)}s old), refreshing in background...")
+        threading.Thread(target=_refresh_trends, args=(region_code,), daemon=True).start()
+
+    return snapshot["trends"]
+
+# ✅ اولویت‌بندی موضوعات مرتبط
+TOPIC_KEYWORDS = ["minecraft", "gaming", "ai", "technology", "computers", "knowledge"]
 
+def _score_trending_topics(valid_trends):
     # ✅ وزن‌دهی به منابع مختلف
     source_weights = {
         "YouTube": 2,  # یوتیوب ارزش بیشتری دارد
@@ -214,13 +478,37 @@ def select_best_trending_topic(trends):
         topic_scores[title] += weight * (1 + (popularity / 100))  # امتیاز نهایی
 
     # مرتب‌سازی بر اساس امتیاز نهایی
-    sorted_topics = sorted(topic_scores.items(), key=lambda x: x[1], reverse=True)
+    return sorted(topic_scores.items(), key=lambda x: x[1], reverse=True)
 
-    # ✅ اولویت‌بندی موضوعات مرتبط
-    keywords = ["minecraft", "gaming", "ai", "technology", "computers", "knowledge"]
+def _is_relevant_topic(topic):
+    return any(re.search(rf"\b{re.escape(keyword)}\b", topic, re.IGNORECASE) for keyword in TOPIC_KEYWORDS)
+
+def select_trending_topics(trends, count):
+    """ انتخاب count موضوع متفاوت برای تولید دسته‌ای؛ موضوعات مرتبط اول، سپس پرامتیازترها """
+    valid_trends = [t for t in trends or [] if isinstance(t, dict) and "title" in t and "source" in t]
+    sorted_topics = _score_trending_topics(valid_trends)
+    relevant = [topic for topic, _ in sorted_topics if _is_relevant_topic(topic)]
+    others = [topic for topic, _ in sorted_topics if not _is_relevant_topic(topic)]
+    return (relevant + others)[:count]
+
+def select_best_trending_topic(trends):
+    """ انتخاب بهترین موضوع ترند شده از لیست یوتیوب و ردیت، بر اساس تعداد تکرار و محبوبیت """
+
+    if not trends or not isinstance(trends, list):
+        print("❌ No trending topics found or invalid format.")
+        return None
+
+    # ✅ فیلتر داده‌های نامعتبر (باید حداقل 'title' و 'source' داشته باشند)
+    valid_trends = [t for t in trends if isinstance(t, dict) and "title" in t and "source" in t]
+
+    if not valid_trends:
+        print("❌ No valid trending topics found.")
+        return None
+
+    sorted_topics = _score_trending_topics(valid_trends)
 
     for topic, score in sorted_topics:
-        if any(re.search(rf"\b{re.escape(keyword)}\b", topic, re.IGNORECASE) for keyword in keywords):
+        if _is_relevant_topic(topic):
             print(f"✅ Best topic selected: {topic} (Score: {score:.2f})")
             return topic
 
@@ -231,14 +519,277 @@ def select_best_trending_topic(trends):
 
     return best_fallback_topic
 
-# 🚀 اجرای تابع
-trending_data = fetch_all_trends()
-best_topic = select_best_trending_topic(trending_data)
-trends = fetch_all_trends()
-topic = select_best_trending_topic(trends)  # ✅ Pass `trends` as argument
+# دانلود موازی فایل‌های بزرگ با درخواست‌های HTTP Range
+DOWNLOAD_PARTS = int(os.getenv("DOWNLOAD_PARTS", "8"))
+DOWNLOAD_MIN_PARALLEL_BYTES = 8 * 1024 * 1024  # فایل‌های کوچک‌تر در یک درخواست دانلود می‌شوند
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+def _download_range(url, part_path, start, end, headers):
+    """
+    دانلود بازه‌ی [start, end] در فایل part_path. اگر بخشی از قبل دانلود شده باشد،
+    از همان‌جا ادامه داده می‌شود.
+    """
+    expected = end - start + 1
+    for attempt in range(DOWNLOAD_RETRIES):
+        done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if done == expected:
+            return done
+        if done > expected:
+            # بیشتر از بازه: بخش خراب است و از نو دانلود می‌شود
+            print(f"⚠ Range {start}-{end} has {done}/{expected} bytes, discarding corrupt part.")
+            os.remove(part_path)
+            done = 0
+        try:
+            range_headers = dict(headers, Range=f"bytes={start + done}-{end}")
+            with requests.get(url, headers=range_headers, stream=True, timeout=30) as response:
+                if response.status_code != 206:
+                    raise requests.HTTPError(f"expected 206 Partial Content, got {response.status_code}")
+                with open(part_path, "ab") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        f.write(chunk)
+        except requests.RequestException as e:
+            print(f"⚠ Range {start}-{end} failed (attempt {attempt + 1}/{DOWNLOAD_RETRIES}): {e}")
+            sleep(2 ** attempt)
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+def _expected_checksum(response):
+    """Checksum advertised by the server, if any: ('md5', hex) from Content-MD5 or x-goog-hash."""
+    for header in (response.headers.get("x-goog-hash", "").split(",") + [f"md5={response.headers.get('Content-MD5', '')}"]):
+        name, _, value = header.strip().partition("=")
+        if name == "md5" and value:
+            try:
+                return "md5", base64.b64decode(value).hex()
+            except ValueError:
+                continue
+    return None
+
+def download_file(url, output_path, sha256=None, parts=DOWNLOAD_PARTS, headers=None):
+    """
+    دانلود یک فایل با چند درخواست Range موازی، ادامه‌ی دانلود ناقص بعد از خطا،
+    بررسی حجم (و checksum در صورت وجود) و انتقال اتمیک به نام نهایی.
+    در صورت موفقیت مسیر فایل و در غیر این صورت None برمی‌گرداند.
+    """
+    headers = dict(headers or {})
+    try:
+        head = requests.head(url, headers=headers, allow_redirects=True, timeout=10)
+        head.raise_for_status()
+    except requests.RequestException as e:
+        print(f"❌ Could not query {url}: {e}")
+        return None
+
+    url = head.url  # بعد از redirect، بازه‌ها مستقیم از سرور نهایی گرفته می‌شوند
+    total_size = int(head.headers.get("Content-Length", 0))
+    ranged = head.headers.get("Accept-Ranges", "").lower() == "bytes" and total_size > 0
+    if not ranged or total_size < DOWNLOAD_MIN_PARALLEL_BYTES:
+        parts = 1
+
+    partial_dir = f"{output_path}.parts"
+    os.makedirs(partial_dir, exist_ok=True)
+
+    # اگر حجم فایل روی سرور عوض شده باشد، بخش‌های قبلی معتبر نیستند
+    state_file = os.path.join(partial_dir, "state.json")
+    state = _read_json_file(state_file, {})
+    if state.get("size") != total_size or state.get("parts") != parts:
+        for name in os.listdir(partial_dir):
+            os.remove(os.path.join(partial_dir, name))
+        _write_json_atomic(state_file, {"url": url, "size": total_size, "parts": parts})
+
+    started = monotonic()
+    if ranged:
+        part_size = -(-total_size // parts)
+        ranges = [(i * part_size, min(total_size, (i + 1) * part_size) - 1) for i in range(parts)]
+        with ThreadPoolExecutor(max_workers=parts) as executor:
+            list(executor.map(lambda r: _download_range(url, os.path.join(partial_dir, f"{r[0]}.part"), r[0], r[1], headers), ranges))
+        part_files = [os.path.join(partial_dir, f"{start}.part") for start, _ in ranges]
+    else:
+        # سرور از Range پشتیبانی نمی‌کند: یک درخواست ساده
+        part_files = [os.path.join(partial_dir, "0.part")]
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                with open(part_files[0], "wb") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        f.write(chunk)
+        except requests.RequestException as e:
+            print(f"❌ Download failed: {e}")
+            return None
+
+    downloaded_size = sum(os.path.getsize(path) for path in part_files if os.path.exists(path))
+    if total_size and downloaded_size < total_size:
+        print(f"❌ Download incomplete ({downloaded_size}/{total_size} bytes); partial data kept for resume.")
+        return None
+    if total_size and downloaded_size > total_size:
+        # داده‌ی اضافه یعنی بخش‌ها خراب‌اند؛ ادامه دادن از آن‌ها فقط همین خطا را تکرار می‌کند
+        print(f"❌ Download corrupt ({downloaded_size}/{total_size} bytes); discarding partial data.")
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        return None
+
+    # چسباندن بخش‌ها در یک فایل موقت و محاسبه‌ی هش همزمان
+    tmp_path = f"{output_path}.tmp"
+    md5, sha = hashlib.md5(), hashlib.sha256()
+    with open(tmp_path, "wb") as out:
+        for path in part_files:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b""):
+                    out.write(block)
+                    md5.update(block)
+                    sha.update(block)
+
+    expected = _expected_checksum(head)
+    if (sha256 and sha.hexdigest() != sha256.lower()) or (expected and md5.hexdigest() != expected[1]):
+        print("❌ Checksum mismatch, discarding download.")
+        os.remove(tmp_path)
+        for path in part_files:
+            if os.path.exists(path):
+                os.remove(path)
+        return None
+
+    os.replace(tmp_path, output_path)
+    for name in os.listdir(partial_dir):
+        os.remove(os.path.join(partial_dir, name))
+    os.rmdir(partial_dir)
+
+    elapsed = max(monotonic() - started, 1e-6)
+    print(f"✅ Downloaded {downloaded_size / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({downloaded_size / 1e6 / elapsed:.1f} MB/s, {parts} parts): {output_path}")
+    return output_path
+
+# کتابخانه‌ی محلی ویدیوهای پس‌زمینه: فایل‌ها با هش محتوا نام‌گذاری و در SQLite فهرست می‌شوند
+BACKGROUND_LIBRARY_DIR = os.getenv("BACKGROUND_LIBRARY_DIR", "background_library")
+BACKGROUND_LIBRARY_DB = os.path.join(BACKGROUND_LIBRARY_DIR, "index.sqlite")
+BACKGROUND_LIBRARY_MAX_BYTES = int(os.getenv("BACKGROUND_LIBRARY_MAX_MB", "4096")) * 1024 * 1024
+BACKGROUND_LIBRARY_MIN_CLIPS = int(os.getenv("BACKGROUND_LIBRARY_MIN_CLIPS", "5"))  # کمتر از این، کتابخانه از Pixabay رشد می‌کند
+BACKGROUND_QUERY = "Minecraft gameplay"
+
+def _library_connect():
+    os.makedirs(BACKGROUND_LIBRARY_DIR, exist_ok=True)
+    conn = sqlite3.connect(BACKGROUND_LIBRARY_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clips (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            source TEXT NOT NULL,
+            source_id TEXT NOT NULL,
+            query TEXT,
+            duration REAL,
+            width INTEGER,
+            height INTEGER,
+            codec TEXT,
+            size_bytes INTEGER,
+            added_at REAL,
+            last_used_at REAL,
+            use_count INTEGER DEFAULT 0,
+            UNIQUE (source, source_id)
+        )
+    """)
+    return conn
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def library_add_clip(file_path, source, source_id, query=BACKGROUND_QUERY):
+    """ افزودن یک فایل دانلودشده به کتابخانه (فایل به مسیر مبتنی بر هش منتقل می‌شود) """
+    info = probe_media(file_path)
+    if not info:
+        os.remove(file_path)
+        return None
+
+    sha256 = _file_sha256(file_path)
+    extension = os.path.splitext(file_path)[1] or ".mp4"
+    library_path = os.path.join(BACKGROUND_LIBRARY_DIR, f"{sha256}{extension}")
+    if os.path.exists(library_path):
+        os.remove(file_path)  # همان محتوا قبلاً با شناسه‌ی دیگری ذخیره شده
+    else:
+        os.replace(file_path, library_path)
+
+    now = datetime.now(timezone.utc).timestamp()
+    with closing(_library_connect()) as conn, conn:
+        conn.execute("DELETE FROM clips WHERE source = ? AND source_id = ? AND sha256 != ?", (source, str(source_id), sha256))
+        conn.execute("""
+            INSERT OR REPLACE INTO clips
+                (sha256, path, source, source_id, query, duration, width, height, codec, size_bytes, added_at, last_used_at, use_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """, (sha256, library_path, source, str(source_id), query, info["duration"], info["width"], info["height"],
+              info["codec"], os.path.getsize(library_path), now, now))
+
+    library_evict()
+    return library_path
+
+def library_lookup_source(source, source_id, touch=True):
+    """Library path of a clip already downloaded from `source`, or None."""
+    with closing(_library_connect()) as conn:
+        row = conn.execute("SELECT sha256, path FROM clips WHERE source = ? AND source_id = ?", (source, str(source_id))).fetchone()
+    if row and os.path.isfile(row["path"]):
+        if touch:
+            library_touch(row["sha256"])
+        return row["path"]
+    return None
 
-def download_best_minecraft_background(output_video="background.mp4"):
-   #دانلود بهترین ویدیو گیم‌پلی ماینکرفت از Pixabay و ذخیره آن
+def library_select_clips(query=BACKGROUND_QUERY, min_duration=10, min_width=0, codec=None, limit=1):
+    """
+    انتخاب کلیپ از فهرست محلی: کم‌استفاده‌ترها اول (برای تنوع)، سپس کیفیت و طول بیشتر.
+    """
+    sql = "SELECT sha256, path FROM clips WHERE query = ? AND duration >= ? AND width >= ?"
+    params = [query, min_duration, min_width]
+    if codec:
+        sql += " AND codec = ?"
+        params.append(codec)
+    sql += " ORDER BY use_count ASC, width DESC, duration DESC"
+
+    with closing(_library_connect()) as conn:
+        rows = [row for row in conn.execute(sql, params).fetchall() if os.path.isfile(row["path"])]
+
+    selected = rows[:limit]
+    for row in selected:
+        library_touch(row["sha256"])
+    return [row["path"] for row in selected]
+
+def library_clip_count(query=BACKGROUND_QUERY, min_duration=10):
+    with closing(_library_connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM clips WHERE query = ? AND duration >= ?", (query, min_duration)).fetchone()[0]
+
+def library_touch(sha256):
+    with closing(_library_connect()) as conn, conn:
+        conn.execute("UPDATE clips SET last_used_at = ?, use_count = use_count + 1 WHERE sha256 = ?",
+                     (datetime.now(timezone.utc).timestamp(), sha256))
+
+def library_evict(max_bytes=BACKGROUND_LIBRARY_MAX_BYTES):
+    """ حذف کلیپ‌هایی که مدت‌ها استفاده نشده‌اند (LRU) تا حجم کتابخانه زیر سقف بماند """
+    with closing(_library_connect()) as conn, conn:
+        rows = conn.execute("SELECT sha256, path, size_bytes FROM clips ORDER BY last_used_at ASC").fetchall()
+        total = sum(row["size_bytes"] or 0 for row in rows)
+        for row in rows:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(row["path"])
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM clips WHERE sha256 = ?", (row["sha256"],))
+            total -= row["size_bytes"] or 0
+            print(f"🧹 Evicted background clip {row['sha256'][:12]} from library.")
+
+# کارهای موازی (run_batch) نباید همزمان یک کلیپ را در همان مسیر دانلود کنند
+_background_library_lock = threading.Lock()
+
+def download_best_minecraft_background(query=BACKGROUND_QUERY):
+   #دانلود بهترین ویدیو گیم‌پلی ماینکرفت از Pixabay و ذخیره آن در کتابخانه‌ی محلی
+    with _background_library_lock:
+        return _acquire_background(query)
+
+def _acquire_background(query):
+    # اگر کتابخانه به اندازه‌ی کافی کلیپ دارد، بدون هیچ درخواست شبکه انتخاب می‌شود
+    if library_clip_count(query) >= BACKGROUND_LIBRARY_MIN_CLIPS:
+        local_clips = library_select_clips(query)
+        if local_clips:
+            print(f"⚡ Using background from local library: {local_clips[0]}")
+            return local_clips[0]
     
     # دریافت کلید API از متغیر محیطی
     PIXABAY_API_KEY = os.getenv("PIXABAY_API_KEY", None)
@@ -246,11 +797,11 @@ def download_best_minecraft_background(output_video="background.mp4"):
 
     if not PIXABAY_API_KEY:
         print("❌ ERROR: Pixabay API Key is missing! Set 'PIXABAY_API_KEY' in Railway environment variables.")
-        return None
+        return next(iter(library_select_clips(query)), None)
     
     params = {
         "key": PIXABAY_API_KEY,
-        "q": "Minecraft gameplay",
+        "q": query,
         "video_type": "film",
         "per_page": 10  # دریافت 10 ویدیو برتر
     }
@@ -266,7 +817,7 @@ def download_best_minecraft_background(output_video="background.mp4"):
         
         if not data.get("hits"):
             print("❌ No Minecraft videos found on Pixabay.")
-            return None
+            return next(iter(library_select_clips(query)), None)
 
         # مرتب‌سازی ویدیوها بر اساس کیفیت (عرض) و طول ویدیو (حداقل 10 ثانیه)
         sorted_videos = sorted(
@@ -277,52 +828,309 @@ def download_best_minecraft_background(output_video="background.mp4"):
 
         if not sorted_videos:
             print("❌ No suitable videos found (videos too short).")
-            return None
-
-        best_video_url = sorted_videos[0]["videos"]["medium"]["url"]  # لینک بهترین ویدیو
-        print(f"✅ Selected best video: {best_video_url}")
-
-        # دانلود ویدیو با استریم
-        video_response = requests.get(best_video_url, stream=True, timeout=20)
-        video_response.raise_for_status()
+            return next(iter(library_select_clips(query)), None)
 
-        with open(output_video, "wb") as f:
-            total_size = int(video_response.headers.get("content-length", 0))
-            downloaded_size = 0
+        # اولین ویدیویی که هنوز در کتابخانه نیست دانلود می‌شود تا کتابخانه متنوع شود
+        new_videos = [vid for vid in sorted_videos if not library_lookup_source("pixabay", vid["id"], touch=False)]
+        if not new_videos:
+            cached_path = library_lookup_source("pixabay", sorted_videos[0]["id"])
+            print(f"⚡ Best Pixabay video is already in the library: {cached_path}")
+            return cached_path
 
-            for chunk in video_response.iter_content(chunk_size=1024 * 1024):  # 1MB
-                f.write(chunk)
-                downloaded_size += len(chunk)
+        best_video = new_videos[0]
+        best_video_url = best_video["videos"]["medium"]["url"]  # لینک بهترین ویدیو
+        print(f"✅ Selected best video: {best_video_url}")
 
-            # بررسی حجم دانلود شده
-            if total_size > 0 and downloaded_size < total_size * 0.9:  # اگر کمتر از 90٪ حجم دانلود شد
-                print("⚠ WARNING: Video download may be incomplete.")
+        # دانلود موازی با بررسی کامل بودن فایل
+        os.makedirs(BACKGROUND_LIBRARY_DIR, exist_ok=True)
+        download_path = download_file(best_video_url, os.path.join(BACKGROUND_LIBRARY_DIR, f"pixabay_{best_video['id']}.download.mp4"))
+        if not download_path:
+            print("❌ Background download failed.")
+            return next(iter(library_select_clips(query)), None)
 
+        output_video = library_add_clip(download_path, "pixabay", best_video["id"], query)
         print(f"✅ Downloaded best background video: {output_video}")
         return output_video
 
     except requests.RequestException as e:
         print(f"❌ Error fetching or downloading video: {e}")
+        return next(iter(library_select_clips(query)), None)
+
+FITTED_BACKGROUND_FILE = "background_fitted.mp4"
+
+def probe_media(path):
+    """ اطلاعات استریم ویدیو (مدت، رزولوشن، کدک) با ffprobe """
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,width,height,pix_fmt,r_frame_rate:format=duration",
+        "-of", "json", path
+    ]
+    try:
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        data = json.loads(result.stdout)
+        stream = data["streams"][0]
+        return {
+            "duration": float(data["format"]["duration"]),
+            "width": int(stream["width"]),
+            "height": int(stream["height"]),
+            "codec": stream["codec_name"],
+            "pix_fmt": stream.get("pix_fmt"),
+            "frame_rate": stream.get("r_frame_rate")
+        }
+    except (subprocess.CalledProcessError, OSError, ValueError, KeyError, IndexError) as e:
+        print(f"❌ Could not probe {path}: {e}")
         return None
 
-# تست دانلود بهترین ویدیو
-download_best_minecraft_background()
+def probe_keyframes(path):
+    """Timestamps (seconds) of the video keyframes, read from packet flags without decoding."""
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0", path
+    ]
+    try:
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"❌ Could not read keyframes of {path}: {e}")
+        return []
 
-def generate_video_script(topic):
-    if not topic:
-        print("❌ Error: No topic provided!")
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+def _keyframe_cut(keyframes, position, clip_duration):
+    """First keyframe at or after `position`, so stream-copied segments end on a GOP boundary."""
+    for keyframe in keyframes:
+        if keyframe >= position:
+            return min(keyframe, clip_duration)
+    return clip_duration
+
+def fit_background_to_duration(clips, duration, output_video=FITTED_BACKGROUND_FILE):
+    """
+    ساخت تایم‌لاین پس‌زمینه دقیقاً به اندازه‌ی صداگذاری: کلیپ‌ها تکرار یا پشت سر هم
+    چیده می‌شوند و تا جای ممکن بدون encode مجدد (stream copy) کپی می‌شوند.
+    """
+    if isinstance(clips, str):
+        clips = [clips]
+
+    infos = [probe_media(clip) for clip in clips]
+    clips = [clip for clip, info in zip(clips, infos) if info and info["duration"] > 0]
+    infos = [info for info in infos if info and info["duration"] > 0]
+    if not clips:
+        print("❌ Error: No usable background clips to fit.")
+        return None
+
+    # stream copy فقط وقتی ممکن است که همه‌ی کلیپ‌ها کدک و رزولوشن یکسان داشته باشند
+    signature = lambda info: (info["codec"], info["width"], info["height"], info["pix_fmt"], info["frame_rate"])
+    can_copy = all(signature(info) == signature(infos[0]) for info in infos)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="background_") as work_dir:
+            if len(clips) == 1 and can_copy:
+                loops = max(0, int(np.ceil(duration / infos[0]["duration"])) - 1)
+                command = [
+                    "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                    "-stream_loop", str(loops), "-i", clips[0],
+                    "-map", "0:v:0", "-c", "copy", "-an",
+                    "-t", f"{duration:.3f}", "-avoid_negative_ts", "make_zero",
+                    output_video
+                ]
+            elif can_copy:
+                # فهرست concat demuxer: کلیپ‌ها به نوبت تا پوشش کامل مدت صدا؛ آخرین برش روی keyframe
+                lines = []
+                covered = 0.0
+                i = 0
+                while covered < duration:
+                    clip, info = clips[i % len(clips)], infos[i % len(infos)]
+                    remaining = duration - covered
+                    escaped = os.path.abspath(clip).replace("'", "'\\''")
+                    lines.append(f"file '{escaped}'")
+                    if remaining < info["duration"]:
+                        outpoint = _keyframe_cut(probe_keyframes(clip), remaining, info["duration"])
+                        lines.append(f"outpoint {outpoint:.3f}")
+                    covered += info["duration"]
+                    i += 1
+
+                list_file = os.path.join(work_dir, "timeline.txt")
+                with open(list_file, "w", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+
+                command = [
+                    "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                    "-f", "concat", "-safe", "0", "-i", list_file,
+                    "-map", "0:v:0", "-c", "copy", "-an",
+                    "-t", f"{duration:.3f}", "-avoid_negative_ts", "make_zero",
+                    output_video
+                ]
+            else:
+                # کلیپ‌های ناهمگون: یک بار encode سریع به رزولوشن کلیپ اول
+                print("⚠ Background clips differ in codec/resolution, re-encoding the timeline.")
+                width, height = infos[0]["width"], infos[0]["height"]
+                inputs, labels, filters = [], [], []
+                covered = 0.0
+                i = 0
+                while covered < duration:
+                    inputs += ["-i", clips[i % len(clips)]]
+                    filters.append(f"[{i}:v]scale={width}:{height}:force_original_aspect_ratio=increase,"
+                                   f"crop={width}:{height},fps={RENDER_FPS},format=yuv420p,setsar=1[v{i}]")
+                    labels.append(f"[v{i}]")
+                    covered += infos[i % len(infos)]["duration"]
+                    i += 1
+                filters.append(f"{''.join(labels)}concat=n={len(labels)}:v=1:a=0[v]")
+
+                command = [
+                    "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                    *inputs,
+                    "-filter_complex", ";".join(filters),
+                    "-map", "[v]", "-c:v", "libx264", "-preset", "ultrafast", "-an",
+                    "-t", f"{duration:.3f}",
+                    output_video
+                ]
+
+            _run_ffmpeg(command)
+
+    except subprocess.CalledProcessError as e:
+        print(f"❌ FFmpeg Error: {e.stderr.decode('utf-8', errors='ignore')}")
         return None
 
-    # Get API key from Railway environment variables
-    TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
-    if not TOGETHER_API_KEY:
-        print("❌ Error: Missing TOGETHER_API_KEY key!")
+    print(f"✅ Background fitted to {duration:.1f}s ({'stream copy' if can_copy else 're-encoded'}): {output_video}")
+    return output_video
+
+# یک کلاینت Together مشترک (اتصال‌های HTTP آن بین همه‌ی فراخوانی‌ها و threadها reuse می‌شوند) + کش پاسخ روی دیسک.
+# کش فقط برای بررسی‌های کپی‌رایت/سیاست‌ها است؛ متن و متادیتای خلاقانه هر بار تازه ساخته می‌شوند.
+LLM_MODEL = os.getenv("LLM_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free")
+LLM_TIMEOUT = 120
+LLM_MAX_RETRIES = 3
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # 0 = کش غیرفعال
+
+client = None
+_client_lock = threading.Lock()
+
+def get_together_client():
+    """Return the shared Together client, creating it on first use."""
+    global client
+
+    with _client_lock:
+        if client is None:
+            TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+            if not TOGETHER_API_KEY:
+                print("❌ ERROR: Together AI API Key is missing! Set 'TOGETHER_API_KEY' in Railway environment variables.")
+                return None
+            client = Together(api_key=TOGETHER_API_KEY, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+
+        return client
+
+def llm_cache_key(prompt, model=LLM_MODEL, **params):
+    """Cache key: model + prompt hash + sampling parameters."""
+    payload = {
+        "model": model,
+        "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        "params": params
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _llm_cache_file(key):
+    return os.path.join(LLM_CACHE_DIR, key[:2], f"{key}.json")
+
+def load_cached_completion(key, ttl=LLM_CACHE_TTL):
+    entry = _read_json_file(_llm_cache_file(key), None)
+    if not entry:
+        return None
+    if datetime.now(timezone.utc).timestamp() - entry.get("created", 0) > ttl:
+        try:
+            os.remove(_llm_cache_file(key))  # منقضی شده
+        except OSError:
+            pass
         return None
+    return entry.get("content")
 
-    # Initialize the Together AI client
-    client = Together(api_key=TOGETHER_API_KEY)
+def store_cached_completion(key, content):
+    os.makedirs(os.path.dirname(_llm_cache_file(key)), exist_ok=True)
+    _write_json_atomic(_llm_cache_file(key), {"created": datetime.now(timezone.utc).timestamp(), "content": content})
 
-    prompt = f"""
+def parse_json_object(content):
+    """ اولین شیء JSON داخل پاسخ مدل (بدون بلاک‌های مارک‌داون) """
+    json_match = re.search(r"\{.*\}", content, re.DOTALL)
+    return json.loads(json_match.group(0) if json_match else content)
+
+def llm_complete(prompt, model=LLM_MODEL, use_cache=False, ttl=LLM_CACHE_TTL, validate=None, **params):
+    """
+    یک chat completion با کلاینت مشترک. با use_cache=True پاسخ بر اساس مدل، hash پرامپت و پارامترها کش می‌شود
+    (برای فراخوانی‌های قطعی مثل بررسی‌ها، نه متن‌های خلاقانه).
+    validate (اختیاری) روی متن پاسخ اجرا می‌شود و اگر خطا بدهد، پاسخ کش نمی‌شود.
+    متن پاسخ را برمی‌گرداند و در صورت خطا exception می‌دهد.
+    """
+    use_cache = use_cache and ttl > 0
+    key = llm_cache_key(prompt, model, **params)
+    if use_cache:
+        cached = load_cached_completion(key, ttl)
+        if cached is not None:
+            print("⚡ LLM response served from cache.")
+            return cached
+
+    together_client = get_together_client()
+    if together_client is None:
+        raise RuntimeError("Together AI client is not configured")
+
+    response = together_client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        **params
+    )
+    if not response.choices:
+        raise ValueError("Empty response from API")
+
+    content = (response.choices[0].message.content or "").strip()
+    if validate:
+        validate(content)
+    if use_cache and content:
+        store_cached_completion(key, content)
+    return content
+
+def llm_stream(prompt, model=LLM_MODEL, use_cache=False, ttl=LLM_CACHE_TTL, **params):
+    """
+    نسخه‌ی streaming از llm_complete: تکه‌های متن را همان لحظه که می‌رسند yield می‌کند.
+    با use_cache=True پاسخ کامل با همان کلید llm_complete کش می‌شود و پاسخ کش‌شده یک‌جا برگردانده می‌شود.
+    """
+    use_cache = use_cache and ttl > 0
+    key = llm_cache_key(prompt, model, **params)
+    if use_cache:
+        cached = load_cached_completion(key, ttl)
+        if cached is not None:
+            print("⚡ LLM response served from cache.")
+            yield cached
+            return
+
+    together_client = get_together_client()
+    if together_client is None:
+        raise RuntimeError("Together AI client is not configured")
+
+    stream = together_client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **params
+    )
+
+    parts = []
+    for event in stream:
+        delta = event.choices[0].delta.content if event.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    content = "".join(parts).strip()
+    if use_cache and content:
+        store_cached_completion(key, content)
+
+def _video_script_prompt(topic):
+    return f"""
     Generate a high-engagement YouTube video script about "{topic}" in an engaging, viral style.
     The script should follow this structure:
 
@@ -338,16 +1146,15 @@ def generate_video_script(topic):
     Now, generate a **high-quality, viral** YouTube script for: "{topic}".
     """
 
-    try:
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo-Free",  # Corrected model name
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.8,
-            max_tokens=700
-        )
+VIDEO_SCRIPT_PARAMS = {"temperature": 0.8, "max_tokens": 700}
+
+def generate_video_script(topic, use_cache=False):
+    if not topic:
+        print("❌ Error: No topic provided!")
+        return None
 
-        # Extract the generated script
-        script = response.choices[0].message.content.strip()
+    try:
+        script = llm_complete(_video_script_prompt(topic), use_cache=use_cache, **VIDEO_SCRIPT_PARAMS)
 
         if not script:
             print("❌ Error: No script received from API")
@@ -359,26 +1166,9 @@ def generate_video_script(topic):
         print(f"❌ API Request Error: {e}")
         return None
 
-# Get API key from Railway environment variables
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "MISSING_API_KEY")
-
-if TOGETHER_API_KEY == "MISSING_API_KEY":
-    print("❌ ERROR: Together AI API Key is missing! Set 'TOGETHER_API_KEY' in Railway environment variables.")
-    exit(1)
-
-# Initialize the Together client with the API key
-client = Together(api_key=TOGETHER_API_KEY)
-
-def generate_video_metadata(topic):
+def generate_video_metadata(topic, use_cache=False):
     print("📝 Generating video metadata...")
 
-    TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
-    if not TOGETHER_API_KEY:
-        print("❌ ERROR: Together AI API Key is missing! Set 'TOGETHER_API_KEY' in Railway environment variables.")
-        return None
-
-    client = Together(api_key=TOGETHER_API_KEY)
-
     prompt = f"""
     Generate an engaging YouTube video title, description, and relevant hashtags for a video about "{topic}".
     
@@ -390,21 +1180,10 @@ def generate_video_metadata(topic):
     """
 
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo-Free",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=500
-        )
+        content = llm_complete(prompt, use_cache=use_cache, temperature=0.7, max_tokens=500)
 
         # Debugging: Print raw API response
-        print("🔍 Raw API Response:", response)
-
-        if not response.choices:
-            raise ValueError("Empty response from API")
-
-        # Extract content
-        content = response.choices[0].message.content.strip()
+        print("🔍 Raw API Response:", content)
 
         # ✅ پاکسازی: حذف بلاک‌های مارک‌داون
         json_match = re.search(r"\{.*\}", content, re.DOTALL)
@@ -428,20 +1207,319 @@ def generate_video_metadata(topic):
         print(f"❌ Error generating metadata: {e}")
         return None
 
-def generate_voiceover(script, output_audio="voiceover.wav"):
+# تنظیمات موتور صداگذاری Bark
+VOICE_PRESET = os.getenv("BARK_VOICE_PRESET", "v2/en_speaker_6")  # یک صدای ثابت برای همه‌ی تکه‌ها
+BARK_SAMPLE_RATE = 24000
+BARK_TEXT_TEMP = 0.7
+BARK_WAVEFORM_TEMP = 0.7
+VOICEOVER_CHUNK_CHARS = 220  # Bark حدود ۱۳ ثانیه صدا تولید می‌کند، پس تکه‌ها کوتاه می‌مانند
+VOICEOVER_CROSSFADE_MS = 40
+# هر worker یک پردازه با نسخه‌ی کامل مدل‌های Bark (چند گیگابایت RAM) است، پس پیش‌فرض عدد کوچک و ثابتی است.
+# با SUNO_USE_SMALL_MODELS=True (که خود Bark می‌خواند) مدل‌های کوچک‌تر بارگذاری می‌شوند و workerهای بیشتری جا می‌شوند.
+VOICEOVER_WORKERS = int(os.getenv("VOICEOVER_WORKERS", "0")) or max(1, min(2, os.cpu_count() or 1))
+# همه‌ی هسته‌ها بین workerها تقسیم می‌شوند تا کم بودن تعداد worker سرعت را محدود نکند
+VOICEOVER_TORCH_THREADS = int(os.getenv("VOICEOVER_TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // VOICEOVER_WORKERS)
+
+# کش صداهای سنتز شده: هر تکه با هش متن، صدا و تنظیمات مدل ذخیره می‌شود
+VOICE_CACHE_DIR = os.getenv("VOICE_CACHE_DIR", "voice_cache")
+VOICE_CACHE_MAX_BYTES = int(os.getenv("VOICE_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+def _clean_script_for_tts(script):
+    """Strip markdown, stage directions and emoji that Bark would read out or mangle."""
+    text = re.sub(r"\d\uFE0F?\u20E3|\*\*[^*\n]{1,60}\*\*\s*:", " ", script)  # شماره‌ها و عنوان بخش‌ها
+    text = re.sub(r"\[[^\]]*\]|\([^)]*(?:sec|music|pause|sfx)[^)]*\)", " ", text, flags=re.IGNORECASE)
+    text = re.sub(r"[*_#`>]+", " ", text)
+    text = re.sub(r"[^\x00-\uFFFF]|[\u2600-\u27BF\uFE0F\u20E3]", " ", text)  # ایموجی‌ها
+    text = re.sub(r"\s+", " ", text)
+    return re.sub(r"\s+([,.!?;:])", r"\1", text).strip()
+
+def _split_long_sentence(sentence, max_chars):
+    """Break an over-long sentence at clause boundaries, then at word boundaries."""
+    pieces = []
+    current = ""
+    for part in re.split(r"(?<=[,;:])\s+|\s+", sentence):
+        candidate = f"{current} {part}".strip()
+        if current and len(candidate) > max_chars:
+            pieces.append(current)
+            current = part
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+def split_script_into_chunks(script, max_chars=VOICEOVER_CHUNK_CHARS):
+    """ تقسیم متن به تکه‌های هم‌اندازه‌ی جمله برای Bark """
+    text = _clean_script_for_tts(script)
+    sentences = [s for s in re.split(r"(?<=[.!?…])\s+", text) if s.strip()]
+
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        if len(sentence) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(_split_long_sentence(sentence, max_chars))
+            continue
+
+        candidate = f"{current} {sentence}".strip()
+        if current and len(candidate) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = candidate
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+def iter_script_chunks(deltas, max_chars=VOICEOVER_CHUNK_CHARS):
+    """
+    تکه‌های TTS را از متنی که به صورت stream می‌رسد، به محض کامل شدن جمله‌ها تولید می‌کند.
+    تقسیم حریصانه روی پیشوند پایدار است، پس نتیجه دقیقاً همان split_script_into_chunks روی متن کامل است
+    (و کلیدهای کش صدا یکسان می‌مانند). آخرین تکه تا رسیدن جمله‌های بعدی نگه داشته می‌شود چون ممکن است بزرگ‌تر شود.
+    """
+    text = ""
+    emitted = 0
+    for delta in deltas:
+        text += delta
+        boundary = max((m.end() for m in re.finditer(r"[.!?…]\S*\s", text)), default=0)
+        if not boundary:
+            continue
+
+        chunks = split_script_into_chunks(text[:boundary], max_chars)
+        for chunk in chunks[emitted:-1]:
+            yield chunk
+        emitted = max(emitted, len(chunks) - 1)
+
+    for chunk in split_script_into_chunks(text, max_chars)[emitted:]:
+        yield chunk
+
+def _init_bark_worker(torch_threads):
+    """Process pool initializer: load torch and the Bark models once per worker."""
+    import torch
+    from bark import preload_models
+
+    torch.set_num_threads(torch_threads)
+    preload_models()
+
+def _synthesize_chunk(text, voice_preset):
+    from bark import generate_audio
+
+    audio = generate_audio(text, history_prompt=voice_preset, text_temp=BARK_TEXT_TEMP,
+                           waveform_temp=BARK_WAVEFORM_TEMP, silent=True)
+    return np.asarray(audio, dtype=np.float32)
+
+def voice_cache_key(text, voice_preset=VOICE_PRESET):
+    """Content address of one synthesized chunk: normalized text + voice + model settings."""
+    normalized = re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+    payload = {
+        "text": normalized,
+        "voice": voice_preset,
+        "text_temp": BARK_TEXT_TEMP,
+        "waveform_temp": BARK_WAVEFORM_TEMP,
+        "small_models": os.getenv("SUNO_USE_SMALL_MODELS", ""),
+        "sample_rate": BARK_SAMPLE_RATE
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _voice_cache_path(key):
+    return os.path.join(VOICE_CACHE_DIR, key[:2], f"{key}.npy")
+
+def load_cached_voice(key):
+    path = _voice_cache_path(key)
+    try:
+        audio = np.load(path)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)  # زمان آخرین استفاده برای LRU
+    except OSError:
+        pass  # evict_voice_cache در job دیگری همین حالا فایل را پاک کرده؛ صدای خوانده‌شده هنوز معتبر است
+    return audio
+
+_voice_cache_lock = threading.Lock()
+
+def store_cached_voice(key, audio):
+    path = _voice_cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # pid و thread id: دو worker که همزمان یک تکه را می‌سازند فایل موقت هم را خراب نمی‌کنند
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+    try:
+        np.save(tmp_path, np.asarray(audio, dtype=np.float32))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠ Could not cache voiceover chunk: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def evict_voice_cache(max_bytes=VOICE_CACHE_MAX_BYTES):
+    """ حذف قدیمی‌ترین تکه‌ها (LRU بر اساس mtime) تا حجم کش زیر سقف برود """
+    with _voice_cache_lock:
+        entries = []
+        for root, _, files in os.walk(VOICE_CACHE_DIR):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+_voiceover_pool = None
+_voiceover_pool_lock = threading.Lock()
+
+def get_voiceover_pool():
+    """Return the shared Bark process pool; workers keep their models loaded between videos."""
+    global _voiceover_pool
+
+    with _voiceover_pool_lock:
+        if _voiceover_pool is None:
+            # spawn: torch با fork سازگار نیست و import کردن YT حالا بدون عوارض جانبی است
+            _voiceover_pool = ProcessPoolExecutor(
+                max_workers=VOICEOVER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_bark_worker,
+                initargs=(VOICEOVER_TORCH_THREADS,)
+            )
+        return _voiceover_pool
+
+def warm_voiceover_pool():
+    """Start every Bark worker now so the first real job doesn't pay for model loading."""
+    pool = get_voiceover_pool()
+    for future in [pool.submit(os.getpid) for _ in range(VOICEOVER_WORKERS)]:
+        future.result()
+
+def _reset_voiceover_pool():
+    global _voiceover_pool
+
+    with _voiceover_pool_lock:
+        if _voiceover_pool is not None:
+            _voiceover_pool.shutdown(wait=False, cancel_futures=True)
+        _voiceover_pool = None
+
+def _trim_silence(audio, sample_rate, threshold=0.01, pad_ms=60):
+    """Trim Bark's leading/trailing silence so chunks join without long gaps."""
+    voiced = np.flatnonzero(np.abs(audio) > threshold)
+    if voiced.size == 0:
+        return audio
+    pad = int(sample_rate * pad_ms / 1000)
+    return audio[max(0, voiced[0] - pad):voiced[-1] + pad]
+
+def crossfade_concat(chunks, sample_rate=BARK_SAMPLE_RATE, crossfade_ms=VOICEOVER_CROSSFADE_MS):
+    """
+    اتصال تکه‌های صدا با crossfade کوتاه در یک آرایه‌ی از پیش تخصیص‌یافته.
+    محدوده‌ی هر تکه (به نمونه) هم برگردانده می‌شود.
+    """
+    fade = int(sample_rate * crossfade_ms / 1000)
+    lengths = [len(chunk) for chunk in chunks]
+    overlaps = [min(fade, lengths[i - 1], lengths[i]) for i in range(1, len(chunks))]
+
+    output = np.zeros(sum(lengths) - sum(overlaps), dtype=np.float32)
+    boundaries = []
+    position = 0
+    for i, chunk in enumerate(chunks):
+        overlap = overlaps[i - 1] if i > 0 else 0
+        start = position - overlap
+        if overlap:
+            ramp = np.linspace(0.0, 1.0, overlap, dtype=np.float32)
+            output[start:position] *= 1.0 - ramp
+            output[start:position] += chunk[:overlap] * ramp
+        output[position:start + len(chunk)] = chunk[overlap:]
+        boundaries.append((start, start + len(chunk)))
+        position = start + len(chunk)
+
+    return output, boundaries
+
+def synthesize_voiceover_stream(chunks, voice_preset=VOICE_PRESET, executor=None):
+    """
+    مثل synthesize_voiceover اما روی یک iterator از تکه‌ها: هر تکه به محض رسیدن به worker فرستاده می‌شود،
+    پس سنتز صدا همزمان با تولید ادامه‌ی متن پیش می‌رود.
+    خروجی: (audio, segments) یا (None, None).
+    """
+    executor = executor or get_voiceover_pool()
+    texts, keys, audio_chunks = [], [], []
+    futures = {}
+
+    try:
+        # فقط جمله‌های جدید یا تغییرکرده سنتز می‌شوند
+        for chunk in chunks:
+            key = voice_cache_key(chunk, voice_preset)
+            audio = load_cached_voice(key)
+            if audio is None:
+                futures[len(texts)] = executor.submit(_synthesize_chunk, chunk, voice_preset)
+            texts.append(chunk)
+            keys.append(key)
+            audio_chunks.append(audio)
+
+        if not texts:
+            print("❌ Error: Script has no speakable text.")
+            return None, None
+
+        if len(futures) < len(texts):
+            print(f"♻ Reusing {len(texts) - len(futures)}/{len(texts)} cached voiceover chunks.")
+        if futures:
+            print(f"🎙 Synthesizing {len(futures)} voiceover chunks on {VOICEOVER_WORKERS} workers...")
+
+        for i, future in futures.items():
+            audio_chunks[i] = future.result()
+            if audio_chunks[i].size:
+                store_cached_voice(keys[i], audio_chunks[i])
+    except BrokenProcessPool as e:
+        print(f"❌ Voiceover worker crashed: {e}")
+        _reset_voiceover_pool()
+        return None, None
+    finally:
+        for future in futures.values():
+            future.cancel()  # اگر متن یا سنتز وسط کار شکست بخورد، کارهای در صف لغو شوند
+        if futures:
+            evict_voice_cache()
+
+    spoken = [(text, _trim_silence(audio, BARK_SAMPLE_RATE)) for text, audio in zip(texts, audio_chunks) if audio.size]
+    if not spoken:
+        print("❌ Error: No audio generated.")
+        return None, None
+
+    audio, boundaries = crossfade_concat([audio for _, audio in spoken])
+    segments = [{"text": text, "start": start, "end": end} for (text, _), (start, end) in zip(spoken, boundaries)]
+
+    print(f"✅ Synthesized {len(audio) / BARK_SAMPLE_RATE:.1f}s of narration.")
+    return audio, segments
+
+def synthesize_voiceover(script, voice_preset=VOICE_PRESET, executor=None):
+    """
+    تولید صداگذاری به‌صورت موازی: متن به تکه‌های جمله‌ای تقسیم، هر تکه در یک worker
+    سنتز و نتیجه با crossfade به یک آرایه‌ی float32 تبدیل می‌شود.
+    خروجی: (audio, segments) که segments شامل متن و محدوده‌ی نمونه‌ی هر تکه است.
+    """
     if not script or not isinstance(script, str):
         print("❌ Error: Invalid script provided!")
-        return None
+        return None, None
 
+    return synthesize_voiceover_stream(split_script_into_chunks(script), voice_preset, executor)
+
+def generate_voiceover(script, output_audio="voiceover.wav"):
     try:
-        audio_array = generate_audio(script)  # Bark-based voice generation
-        
-        if not isinstance(audio_array, np.ndarray) or audio_array.size == 0:
+        audio_array, _ = synthesize_voiceover(script)  # Bark-based voice generation
+
+        if audio_array is None or audio_array.size == 0:
             print("❌ Error: No audio generated.")
             return None
-        
-        sample_rate = 24000
-        write(output_audio, sample_rate, np.array(audio_array * 32767, dtype=np.int16))
+
+        from scipy.io.wavfile import write
+
+        write(output_audio, BARK_SAMPLE_RATE, np.array(np.clip(audio_array, -1.0, 1.0) * 32767, dtype=np.int16))
         
         print(f"✅ Voiceover generated successfully: {output_audio}")
         return output_audio
@@ -450,8 +1528,70 @@ def generate_voiceover(script, output_audio="voiceover.wav"):
         print(f"❌ Error generating voiceover: {str(e)}")
         return None
 
-def generate_video(voiceover, background_video, output_video="final_video.mp4"):
-    if not os.path.isfile(voiceover):
+PCM_BLOCK_SAMPLES = 1 << 16  # اندازه‌ی بلوک تبدیل float32 → int16 هنگام ارسال به ffmpeg
+
+def _pcm_input_args(sample_rate=BARK_SAMPLE_RATE):
+    """ffmpeg input arguments for mono 16-bit PCM streamed on stdin."""
+    return ["-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0"]
+
+def _write_pcm(stream, samples):
+    """
+    ارسال نمونه‌های float32 به صورت PCM 16 بیتی، بلوک به بلوک و با یک بافر int16 ثابت،
+    بدون ساختن کپی کامل از کل صدا.
+    """
+    scratch_float = np.empty(PCM_BLOCK_SAMPLES, dtype=np.float32)
+    scratch_pcm = np.empty(PCM_BLOCK_SAMPLES, dtype=np.int16)
+
+    for offset in range(0, len(samples), PCM_BLOCK_SAMPLES):
+        block = samples[offset:offset + PCM_BLOCK_SAMPLES]
+        n = len(block)
+        np.multiply(block, 32767.0, out=scratch_float[:n])
+        np.clip(scratch_float[:n], -32768, 32767, out=scratch_float[:n])
+        np.copyto(scratch_pcm[:n], scratch_float[:n], casting="unsafe")
+        stream.write(scratch_pcm[:n].tobytes())
+
+def _run_ffmpeg(command, pcm=None):
+    """
+    Run an ffmpeg command, optionally streaming `pcm` (float32 samples) into its stdin.
+    Raises subprocess.CalledProcessError with the captured stderr on failure.
+    """
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if pcm is not None else subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+
+    # stderr در یک thread جدا خوانده می‌شود تا ffmpeg هنگام نوشتن روی pipe قفل نشود
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    try:
+        if pcm is not None:
+            try:
+                _write_pcm(process.stdin, pcm)
+            except BrokenPipeError:
+                pass  # ffmpeg زودتر خارج شد؛ خطای واقعی در stderr است
+            finally:
+                process.stdin.close()
+        returncode = process.wait()
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        stderr_reader.join()
+
+    stderr = b"".join(stderr_chunks)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+    return stderr
+
+def generate_video(voiceover, background_video, output_video="final_video.mp4", sample_rate=BARK_SAMPLE_RATE):
+    """ voiceover می‌تواند مسیر فایل صدا یا آرایه‌ی float32 نمونه‌ها باشد (بدون فایل موقت) """
+    in_memory = isinstance(voiceover, np.ndarray)
+
+    if not in_memory and not os.path.isfile(voiceover):
         print(f"❌ Error: Voiceover file not found ({voiceover})")
         return None
 
@@ -460,15 +1600,17 @@ def generate_video(voiceover, background_video, output_video="final_video.mp4"):
         return None
 
     try:
+        audio_input = _pcm_input_args(sample_rate) if in_memory else ["-i", voiceover]
         command = [
-            "ffmpeg", "-y",
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
             "-i", background_video,
-            "-i", voiceover,
+            *audio_input,
+            "-map", "0:v:0", "-map", "1:a:0",
             "-c:v", "copy",
             "-c:a", "aac",
             output_video
         ]
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _run_ffmpeg(command, pcm=voiceover if in_memory else None)
 
         if not os.path.isfile(output_video):
             print("❌ Error: Video file not created.")
@@ -484,7 +1626,33 @@ def generate_video(voiceover, background_video, output_video="final_video.mp4"):
         print(f"❌ Unexpected error: {str(e)}")
         return None
 
+def enhance_audio_samples(samples, sample_rate=BARK_SAMPLE_RATE, target_dBFS=-14.0):
+    """
+    همان پردازش enhance_audio روی آرایه‌ی float32 و به صورت درجا (in place):
+    فیلتر high-pass در 100Hz و تنظیم بلندی صدا به target_dBFS.
+    """
+    from scipy.signal import butter, sosfilt, sosfilt_zi
+
+    # حذف نویز‌های کم‌دامنه (فیلتر high-pass) بلوک به بلوک با حفظ حالت فیلتر
+    sos = butter(2, 100, btype="highpass", fs=sample_rate, output="sos")
+    zi = sosfilt_zi(sos) * (samples[0] if len(samples) else 0.0)
+    for offset in range(0, len(samples), PCM_BLOCK_SAMPLES):
+        block = samples[offset:offset + PCM_BLOCK_SAMPLES]
+        filtered, zi = sosfilt(sos, block, zi=zi)
+        block[:] = filtered
+
+    # تنظیم مقدار بلندی صدا در حد متعادل (dBFS بر اساس RMS، مثل pydub)
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if len(samples) else 0.0
+    if rms > 0:
+        gain = 10 ** (target_dBFS / 20) / rms
+        np.multiply(samples, gain, out=samples)
+    np.clip(samples, -1.0, 1.0, out=samples)
+    return samples
+
 def enhance_audio(input_audio, output_audio="enhanced_voiceover.mp3"):
+    if isinstance(input_audio, np.ndarray):
+        return enhance_audio_samples(input_audio)  # مسیر درون‌حافظه‌ای، بدون خروجی MP3
+
     if not os.path.isfile(input_audio):
         print(f"❌ Error: Input audio file not found ({input_audio})")
         return None
@@ -517,182 +1685,1020 @@ def enhance_audio(input_audio, output_audio="enhanced_voiceover.mp3"):
         print(f"❌ Error enhancing audio: {e}")
         return None
 
-def enhance_video(input_video, output_video="enhanced_video.mp4"):
-    if not os.path.isfile(input_video):
-        print(f"❌ Error: Input video file not found ({input_video})")
-        return None
+# عنوان‌هایی که قبلاً enhance_video و add_video_effects با moviepy اضافه می‌کردند (به همان ترتیب لایه‌ها)
+TITLE_FONT = os.getenv("TITLE_FONT", "Arial:style=Bold")  # نام fontconfig یا مسیر فایل .ttf
+VIDEO_OVERLAYS = [
+    {"text": "🔥 Minecraft Fact!", "fontsize": 70, "color": "white", "border": 3, "start": 0, "end": 3, "fade": 0},
+    {"text": "🔥 Amazing Minecraft Fact!", "fontsize": 80, "color": "yellow", "border": 5, "start": 0, "end": 3, "fade": 0.5},
+]
+RENDER_FPS = 30
+RENDER_AUDIO_RATE = 48000
+RENDER_AUDIO_FADE = 0.3
+
+# پروفایل‌های encode؛ preset کندترین (کم‌حجم‌ترین) presetی است که اگر وقت باشد استفاده می‌شود
+ENCODE_PROFILES = {
+    "4K": {"size": (3840, 2160), "crf": 20, "preset": "slow", "gop": RENDER_FPS * 2, "threads": 0},  # 0 = همه‌ی هسته‌ها
+    "1080p": {"size": (1920, 1080), "crf": 21, "preset": "slow", "gop": RENDER_FPS * 2, "threads": 0},
+    "shorts": {"size": (1080, 1920), "crf": 22, "preset": "medium", "gop": RENDER_FPS, "threads": 0}
+}
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+# سرعت نسبی هر preset نسبت به ultrafast؛ فقط تا وقتی آن preset روی این سیستم اندازه‌گیری نشده استفاده می‌شود
+X264_PRESET_SPEED = {
+    "ultrafast": 1.0, "superfast": 0.8, "veryfast": 0.6, "faster": 0.45, "fast": 0.35,
+    "medium": 0.28, "slow": 0.17, "slower": 0.08, "veryslow": 0.04
+}
+DEFAULT_ULTRAFAST_SPEED = {"4K": 1.0, "1080p": 4.0, "shorts": 4.0}  # ثانیه‌ی ویدیو به ازای هر ثانیه‌ی encode
+ENCODE_SPEED_FILE = "encode_speeds.json"
+ENCODE_TIME_SAFETY = 1.3
+SEGMENTED_SPEED_SUFFIX = "+segmented"  # سرعت wall-clock رندر موازی جدا از encode تک‌مرحله‌ای نگه داشته می‌شود
+
+_encode_speeds_lock = threading.Lock()
+
+def record_encode_speed(profile_name, preset, media_seconds, wall_seconds, alpha=0.3, frame_size=None):
+    """
+    ذخیره‌ی EWMA سرعت encode (ثانیه‌ی ویدیو در هر ثانیه) برای هر پروفایل و preset روی همین سیستم.
+    encodeهایی که با frame_size کوچک‌تر از اندازه‌ی پروفایل انجام شده‌اند ثبت نمی‌شوند تا تخمین اندازه‌ی کامل را خراب نکنند.
+    """
+    if wall_seconds <= 0 or media_seconds <= 0:
+        return
+    base_profile = profile_name[:-len(SEGMENTED_SPEED_SUFFIX)] if profile_name.endswith(SEGMENTED_SPEED_SUFFIX) else profile_name
+    if frame_size and tuple(frame_size) != tuple(ENCODE_PROFILES[base_profile]["size"]):
+        return
 
-    try:
-        clip = VideoFileClip(input_video)
+    with _encode_speeds_lock:
+        speeds = _read_json_file(ENCODE_SPEED_FILE, {})
+        key = f"{profile_name}:{preset}"
+        speed = media_seconds / wall_seconds
+        speeds[key] = speed if key not in speeds else (1 - alpha) * speeds[key] + alpha * speed
+        _write_json_atomic(ENCODE_SPEED_FILE, speeds)
+
+def estimate_encode_speed(profile_name, preset, speeds=None):
+    """ سرعت اندازه‌گیری‌شده؛ در غیر این صورت تخمین از presetهای اندازه‌گیری‌شده‌ی همان پروفایل """
+    speeds = _read_json_file(ENCODE_SPEED_FILE, {}) if speeds is None else speeds
+    if f"{profile_name}:{preset}" in speeds:
+        return speeds[f"{profile_name}:{preset}"]
+
+    scaled = [speed * X264_PRESET_SPEED[preset] / X264_PRESET_SPEED[key.split(":", 1)[1]]
+              for key, speed in speeds.items() if key.startswith(f"{profile_name}:")]
+    if scaled:
+        return sum(scaled) / len(scaled)
+    if profile_name.endswith(SEGMENTED_SPEED_SUFFIX):
+        # هنوز رندر موازی اندازه‌گیری نشده: سرعت تک‌مرحله‌ای همان پروفایل (محافظه‌کارانه)
+        return estimate_encode_speed(profile_name[:-len(SEGMENTED_SPEED_SUFFIX)], preset, speeds)
+    return DEFAULT_ULTRAFAST_SPEED.get(profile_name, 1.0) * X264_PRESET_SPEED[preset]
+
+def select_encode_preset(profile_name, duration, deadline=None, speed_key=None):
+    """
+    کندترین preset (تا preset پروفایل) که encode آن با سرعت اندازه‌گیری‌شده قبل از deadline تمام شود.
+    بدون deadline همان preset پروفایل برگردانده می‌شود. speed_key کلید سرعت‌ها را عوض می‌کند (مثلاً رندر قطعه‌ای).
+    """
+    profile = ENCODE_PROFILES[profile_name]
+    if deadline is None or not duration:
+        return profile["preset"]
 
-        # ایجاد متن عنوان با پس‌زمینه‌ی نیمه‌شفاف
-        title_text = (TextClip("🔥 Minecraft Fact!", fontsize=70, font="Arial-Bold", color="white", stroke_color="black", stroke_width=3)
-                      .set_position(("center", "top"))
-                      .set_duration(3))
+    budget = (deadline - datetime.now(timezone.utc)).total_seconds()
+    speeds = _read_json_file(ENCODE_SPEED_FILE, {})
+    for preset in reversed(X264_PRESETS[:X264_PRESETS.index(profile["preset"]) + 1]):
+        if duration / estimate_encode_speed(speed_key or profile_name, preset, speeds) * ENCODE_TIME_SAFETY <= budget:
+            print(f"⚡ Encoding {profile_name} with preset '{preset}' ({budget:.0f}s left before the deadline).")
+            return preset
 
-        # ترکیب متن با ویدیو
-        final_clip = CompositeVideoClip([clip, title_text])
+    print(f"⚠ Only {budget:.0f}s left; encoding {profile_name} with 'ultrafast' and it may still be late.")
+    return "ultrafast"
 
-        # ذخیره خروجی با کیفیت بالا
-        final_clip.write_videofile(output_video, codec="libx264", fps=30, threads=4, preset="ultrafast")
+def fit_encode_profile(profile_name, background_video):
+    """
+    پروفایل و اندازه‌ی خروجی بدون upscale: اگر منبع از پروفایل کوچک‌تر باشد، پروفایل هم‌نسبت کوچک‌تری
+    که در منبع جا شود (مثلاً 4K -> 1080p) و در غیر این صورت اندازه‌ی پروفایل به ناحیه‌ی crop منبع محدود می‌شود.
+    اگر منبع probe نشود، همان پروفایل برگردانده می‌شود.
+    فقط پروفایل‌های افقی محدود می‌شوند: قاب عمودی (Shorts) از فوتیج افقی همیشه upscale لازم دارد و
+    باید در اندازه‌ی کامل پروفایل بماند.
+    """
+    width, height = ENCODE_PROFILES[profile_name]["size"]
+    if width < height:
+        return profile_name, (width, height)
+
+    info = probe_media(background_video)
+    if not info:
+        return profile_name, (width, height)
+
+    # بزرگ‌ترین ناحیه‌ی crop با نسبت پروفایل که داخل منبع جا می‌شود
+    crop_height = min(info["height"], info["width"] * height // width)
+    if crop_height >= height:
+        return profile_name, (width, height)
+
+    same_aspect = sorted((name for name, profile in ENCODE_PROFILES.items()
+                          if profile["size"][0] * height == profile["size"][1] * width),
+                         key=lambda name: ENCODE_PROFILES[name]["size"][1])
+    fitting = [name for name in same_aspect if ENCODE_PROFILES[name]["size"][1] <= crop_height]
+    if fitting:
+        print(f"⚠ Background is {info['width']}x{info['height']}; rendering {fitting[-1]} instead of {profile_name}.")
+        return fitting[-1], ENCODE_PROFILES[fitting[-1]]["size"]
+
+    # منبع از کوچک‌ترین پروفایل هم‌نسبت هم کوچک‌تر است: همان پروفایل در رزولوشن منبع
+    smallest = same_aspect[0]
+    width, height = ENCODE_PROFILES[smallest]["size"]
+    crop_height -= crop_height % 2
+    print(f"⚠ Background is {info['width']}x{info['height']}; rendering {smallest} at source height {crop_height}.")
+    return smallest, (width * crop_height // height // 2 * 2, crop_height)
+
+def encode_settings(profile_name, duration=None, deadline=None, preset=None, threads=None, frame_size=None,
+                    speed_key=None):
+    """ آرگومان‌های encode برای build_render_command از روی پروفایل؛ frame_size اندازه‌ی پروفایل را override می‌کند """
+    profile = ENCODE_PROFILES[profile_name]
+    return {
+        "preset": preset or select_encode_preset(profile_name, duration, deadline, speed_key),
+        "threads": profile["threads"] if threads is None else threads,
+        "crf": profile["crf"],
+        "gop": profile["gop"],
+        "frame_size": frame_size or profile["size"]
+    }
 
-        if not os.path.isfile(output_video):
-            print("❌ Error: Enhanced video file not created.")
-            return None
+def _drawtext_filter(overlay, text_file, scale=1.0):
+    """
+    drawtext equivalent of a moviepy TextClip at ("center", "top") with optional fade in/out.
+    fontsize and border are given for a frame whose short side is 1080 px and multiplied by scale.
+    """
+    start, end, fade = overlay["start"], overlay["end"], overlay.get("fade", 0)
+    font_option = f"fontfile='{TITLE_FONT}'" if TITLE_FONT.lower().endswith((".ttf", ".otf")) else f"font='{TITLE_FONT}'"
+
+    options = [
+        font_option,
+        f"textfile='{text_file}'",
+        "expansion=none",
+        f"fontsize={max(1, round(overlay['fontsize'] * scale))}",
+        f"fontcolor={overlay['color']}",
+        f"borderw={round(overlay.get('border', 0) * scale)}",
+        "bordercolor=black",
+        "x=(w-text_w)/2",
+        "y=0",
+        f"enable='between(t,{start},{end})'"
+    ]
+    if fade:
+        options.append(f"alpha='if(lt(t,{start + fade}),(t-{start})/{fade},if(gt(t,{end - fade}),({end}-t)/{fade},1))'")
+    return "drawtext=" + ":".join(options)
+
+# زیرنویس: متن را خودمان نوشته‌ایم، پس به جای ASR فقط متن معلوم را با صدای تولیدشده هم‌تراز می‌کنیم
+SUBTITLES_ENABLED = os.getenv("SUBTITLES", "1") == "1"
+SUBTITLE_FONT = os.getenv("SUBTITLE_FONT", "Impact")
+SUBTITLE_FONTS_DIR = os.getenv("SUBTITLE_FONTS_DIR", os.path.dirname(os.path.abspath(__file__)))  # impact.ttf کنار YT.py
+SUBTITLE_FONT_SIZE = 72
+SUBTITLE_MAX_CHARS = 28  # حداکثر طول هر خط زیرنویس
+SUBTITLE_FRAME_MS = 10
+SUBTITLE_PAUSE_WEIGHT = 3  # وزن توقف بعد از علائم نگارشی، به واحد حرف
+
+def _voiced_frames(audio, frame, threshold_ratio=0.1):
+    """Boolean mask of frames whose RMS energy is above a fraction of the loud speech level."""
+    usable = len(audio) // frame * frame
+    if not usable:
+        return np.ones(1, dtype=bool)
+    rms = np.sqrt(np.mean(np.square(audio[:usable].reshape(-1, frame)), axis=1))
+    voiced = rms > max(1e-4, threshold_ratio * np.percentile(rms, 95))
+    return voiced if voiced.any() else np.ones_like(voiced)
+
+def align_script_words(audio, segments, sample_rate=BARK_SAMPLE_RATE):
+    """
+    هم‌ترازی کلمه‌به‌کلمه‌ی متن معلوم با صدا، بدون ASR.
+    مرز هر تکه از خروجی TTS (segments) معلوم است؛ داخل هر تکه، زمانِ «صدادار» (بر اساس انرژی فریم‌ها)
+    به نسبت طول حروف هر کلمه (به‌علاوه‌ی وزن مکث بعد از علائم نگارشی) بین کلمه‌ها تقسیم می‌شود،
+    پس سکوت‌ها به هیچ کلمه‌ای نمی‌رسند.
+    خروجی: لیست {"word", "start", "end"} به ثانیه.
+    """
+    frame = max(1, int(sample_rate * SUBTITLE_FRAME_MS / 1000))
+    words = []
+
+    for segment in segments or []:
+        tokens = segment["text"].split()
+        if not tokens:
+            continue
+
+        start, end = segment["start"], min(segment["end"], len(audio))
+        voiced = _voiced_frames(audio[start:end], frame)
+        # زمان صدادار تجمعی (به فریم) → موقعیت فریم در تکه
+        voiced_positions = np.flatnonzero(voiced)
+
+        weights = np.array([len(token) + (SUBTITLE_PAUSE_WEIGHT if token[-1] in ",.!?;:…" else 0) for token in tokens],
+                           dtype=np.float64)
+        edges = np.concatenate([[0.0], np.cumsum(weights) / weights.sum()]) * len(voiced_positions)
+
+        for i, token in enumerate(tokens):
+            first = voiced_positions[min(int(edges[i]), len(voiced_positions) - 1)]
+            last = voiced_positions[max(int(np.ceil(edges[i + 1])) - 1, min(int(edges[i]), len(voiced_positions) - 1))]
+            words.append({
+                "word": token,
+                "start": float((start + first * frame) / sample_rate),
+                "end": float(min(end, start + (last + 1) * frame) / sample_rate)
+            })
+
+    # تکه‌ها در crossfade کمی هم‌پوشانی دارند؛ هیچ کلمه‌ای نباید بعد از شروع کلمه‌ی بعدی تمام شود
+    for word, following in zip(words, words[1:]):
+        word["end"] = max(word["start"], min(word["end"], following["start"]))
+
+    return words
+
+def group_subtitle_lines(words, max_chars=SUBTITLE_MAX_CHARS):
+    """ کلمه‌ها را به خطوط کوتاه زیرنویس تقسیم می‌کند؛ بعد از پایان جمله خط جدید شروع می‌شود """
+    lines = []
+    current = []
+    for word in words:
+        text = " ".join(w["word"] for w in current + [word])
+        if current and (len(text) > max_chars or current[-1]["word"][-1] in ".!?…"):
+            lines.append(current)
+            current = []
+        current.append(word)
+    if current:
+        lines.append(current)
+    return lines
+
+def _srt_timestamp(seconds):
+    millis = int(round(seconds * 1000))
+    return f"{millis // 3600000:02d}:{millis // 60000 % 60:02d}:{millis // 1000 % 60:02d},{millis % 1000:03d}"
+
+def _ass_timestamp(seconds):
+    centis = int(round(seconds * 100))
+    return f"{centis // 360000}:{centis // 6000 % 60:02d}:{centis // 100 % 60:02d}.{centis % 100:02d}"
+
+def _ass_escape(text):
+    return text.replace("\\", "/").replace("{", "(").replace("}", ")")
+
+def write_srt_subtitles(lines, output_file):
+    with open(output_file, "w", encoding="utf-8") as f:
+        for i, line in enumerate(lines, start=1):
+            text = " ".join(w["word"] for w in line)
+            f.write(f"{i}\n{_srt_timestamp(line[0]['start'])} --> {_srt_timestamp(line[-1]['end'])}\n{text}\n\n")
+    return output_file
 
-        print(f"✅ Enhanced video saved: {output_video}")
-        return output_video
+def write_ass_subtitles(lines, output_file, play_res=(1920, 1080), font_size=SUBTITLE_FONT_SIZE, margin_v=120):
+    """ زیرنویس ASS با تگ‌های karaoke (\\k) تا هر کلمه در زمان خودش رنگی شود """
+    header = f"""[Script Info]
+ScriptType: v4.00+
+PlayResX: {play_res[0]}
+PlayResY: {play_res[1]}
+WrapStyle: 2
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,{SUBTITLE_FONT},{font_size},&H0000FFFF,&H00FFFFFF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,5,2,2,60,60,{margin_v},1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(header)
+        for line in lines:
+            parts = []
+            cursor = line[0]["start"]
+            for word in line:
+                # فاصله‌ی قبل از کلمه هم جزو زمان همان کلمه حساب می‌شود تا تگ‌ها پیوسته بمانند
+                duration = max(1, int(round((word["end"] - cursor) * 100)))
+                parts.append(f"{{\\k{duration}}}{_ass_escape(word['word'])}")
+                cursor = word["end"]
+            f.write(f"Dialogue: 0,{_ass_timestamp(line[0]['start'])},{_ass_timestamp(line[-1]['end'])},Default,,0,0,0,,{' '.join(parts)}\n")
+    return output_file
 
+def generate_subtitles(voiceover, segments, output_file="subtitles.srt", sample_rate=BARK_SAMPLE_RATE,
+                       play_res=(1920, 1080)):
+    """
+    ساخت زیرنویس کلمه‌به‌کلمه از متن معلوم و صدای تولیدشده: فایل SRT (برای آپلود) و ASS (برای رندر).
+    خروجی: (srt_file, ass_file) یا (None, None).
+    """
+    try:
+        words = align_script_words(voiceover, segments, sample_rate)
+        if not words:
+            print("⚠ No words to subtitle.")
+            return None, None
+
+        lines = group_subtitle_lines(words)
+        srt_file = write_srt_subtitles(lines, output_file)
+        ass_file = write_ass_subtitles(lines, f"{os.path.splitext(output_file)[0]}.ass", play_res)
+        print(f"✅ Subtitles aligned: {len(words)} words in {len(lines)} lines.")
+        return srt_file, ass_file
     except Exception as e:
-        print(f"❌ Error enhancing video: {e}")
-        return None
+        print(f"❌ Error generating subtitles: {e}")
+        return None, None
+
+def _subtitles_filter(ass_file):
+    return f"ass='{ass_file}':fontsdir='{SUBTITLE_FONTS_DIR}'"
+
+def _render_video_filters(work_dir, overlays=VIDEO_OVERLAYS, subtitles_file=None, frame_size=None):
+    """ زنجیره‌ی فیلتر تصویر: crop/scale، fps، زیرنویس و عنوان‌ها (متن عنوان‌ها در work_dir نوشته می‌شود) """
+    video_filters = []
+    overlay_scale = min(frame_size) / 1080 if frame_size else 1.0  # اندازه‌ی عنوان‌ها برای ضلع کوچک ۱۰۸۰ تعریف شده
+    if frame_size:
+        width, height = frame_size
+        video_filters += [
+            f"crop=w='min(iw,ih*{width}/{height})':h='min(ih,iw*{height}/{width})'",
+            f"scale={width}:{height}",
+            "setsar=1"
+        ]
+    video_filters += [f"fps={RENDER_FPS}", "format=yuv420p"]
+    if subtitles_file:
+        video_filters.append(_subtitles_filter(subtitles_file))
+    for i, overlay in enumerate(overlays):
+        text_file = os.path.join(work_dir, f"title_{i}.txt")
+        with open(text_file, "w", encoding="utf-8") as f:
+            f.write(overlay["text"])
+        video_filters.append(_drawtext_filter(overlay, text_file, overlay_scale))
+    return video_filters
+
+def _render_audio_filters(duration=None):
+    audio_filters = [f"aresample={RENDER_AUDIO_RATE}", "afade=t=in:st=0:d=0.05"]
+    if duration:
+        audio_filters.append(f"afade=t=out:st={max(0.0, duration - RENDER_AUDIO_FADE):.3f}:d={RENDER_AUDIO_FADE}")
+    return audio_filters
+
+def build_render_command(background_video, output_video, work_dir, duration=None, audio_file=None,
+                         overlays=VIDEO_OVERLAYS, sample_rate=BARK_SAMPLE_RATE, preset="ultrafast", threads=4,
+                         subtitles_file=None, background_offset=0.0, frame_size=None, crf=None, gop=None):
+    """
+    ساخت یک فرمان ffmpeg با filter_complex که همه‌ی عنوان‌ها، زیرنویس‌ها، fadeها، فیلترهای صدا و
+    تنظیمات خروجی را در یک encode انجام می‌دهد. بدون audio_file، صدا از stdin (PCM) خوانده می‌شود.
+    frame_size=(w, h) تصویر را با crop مرکزی و scale به آن نسبت می‌برد (مثلاً 1080x1920 برای Shorts).
+    """
+    video_filters = _render_video_filters(work_dir, overlays, subtitles_file, frame_size)
+    audio_filters = _render_audio_filters(duration)
+
+    filter_complex = f"[0:v]{','.join(video_filters)}[v];[1:a]{','.join(audio_filters)}[a]"
+    audio_input = ["-i", audio_file] if audio_file else _pcm_input_args(sample_rate)
+
+    command = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        *(["-ss", f"{background_offset:.3f}"] if background_offset else []),
+        "-i", background_video,
+        *audio_input,
+        "-filter_complex", filter_complex,
+        "-map", "[v]", "-map", "[a]",
+        "-c:v", "libx264", "-preset", preset, "-threads", str(threads),
+        *(["-crf", str(crf)] if crf is not None else []),
+        *(["-g", str(gop)] if gop else []),
+        "-c:a", "aac", "-b:a", "192k",
+        "-movflags", "+faststart"
+    ]
+    command += ["-t", f"{duration:.3f}"] if duration else ["-shortest"]
+    return command + [output_video]
+
+def render_video(voiceover, background_video, output_video="final_video.mp4", overlays=VIDEO_OVERLAYS,
+                 sample_rate=BARK_SAMPLE_RATE, threads=None, subtitles_file=None, profile=VIDEO_QUALITY,
+                 preset=None, deadline=None):
+    """
+    رندر نهایی ویدیو در یک مرحله‌ی encode (جایگزین generate_video + enhance_video + add_video_effects).
+    voiceover می‌تواند آرایه‌ی float32 یا مسیر فایل صدا باشد؛ subtitles_file (ASS) در همان encode سوزانده می‌شود.
+    تنظیمات encode از ENCODE_PROFILES[profile] می‌آید و preset بر اساس deadline انتخاب می‌شود.
+    """
+    in_memory = isinstance(voiceover, np.ndarray)
 
-def add_video_effects(input_video, output_video="final_video_with_effects.mp4"):
-    print("🎬 Adding effects to video...")
+    if not in_memory and not os.path.isfile(voiceover):
+        print(f"❌ Error: Voiceover file not found ({voiceover})")
+        return None
 
-    if not os.path.isfile(input_video):
-        print(f"❌ Error: Input video file not found ({input_video})")
+    if not os.path.isfile(background_video):
+        print(f"❌ Error: Background video file not found ({background_video})")
         return None
 
-    try:
-        # بارگذاری ویدیو
-        clip = VideoFileClip(input_video)
+    duration = len(voiceover) / sample_rate if in_memory else None
 
-        # ایجاد متن گرافیکی متحرک با افکت استروک (حاشیه مشکی برای خوانایی بهتر)
-        txt_clip = (TextClip("🔥 Amazing Minecraft Fact!", fontsize=80, color='yellow', font="Arial-Bold",
-                             stroke_color="black", stroke_width=5)
-                    .set_position(("center", "top"))
-                    .set_duration(3)
-                    .fadein(0.5).fadeout(0.5))  # افکت محو شدن در ابتدا و انتها
+    # ویدیوهای بلند در قطعه‌های هم‌تراز با GOP به صورت موازی encode می‌شوند، مگر تعداد thread از بیرون تعیین شده باشد
+    if in_memory and threads is None and duration >= SEGMENTED_RENDER_MIN_SECONDS and RENDER_SEGMENT_WORKERS > 1:
+        return render_video_segmented(voiceover, background_video, output_video, overlays, sample_rate,
+                                      subtitles_file, profile, preset, deadline)
 
-        # ترکیب ویدیو و متن
-        final_clip = CompositeVideoClip([clip, txt_clip])
+    print("🎬 Rendering final video in a single pass...")
+    profile, frame_size = fit_encode_profile(profile, background_video)
+    settings = encode_settings(profile, duration, deadline, preset, threads, frame_size)
 
-        # ذخیره ویدیو با تنظیمات بهینه
-        final_clip.write_videofile(output_video, codec="libx264", fps=30, threads=4, preset="ultrafast")
+    try:
+        with tempfile.TemporaryDirectory(prefix="render_") as work_dir:
+            command = build_render_command(background_video, output_video, work_dir, duration=duration,
+                                           audio_file=None if in_memory else voiceover,
+                                           overlays=overlays, sample_rate=sample_rate,
+                                           subtitles_file=subtitles_file, **settings)
+            started = monotonic()
+            _run_ffmpeg(command, pcm=voiceover if in_memory else None)
+            if duration:
+                record_encode_speed(profile, settings["preset"], duration, monotonic() - started,
+                                    frame_size=settings["frame_size"])
 
         if not os.path.isfile(output_video):
-            print("❌ Error: Video with effects was not created.")
+            print("❌ Error: Rendered video file not created.")
             return None
 
-        print(f"✅ Video with effects saved: {output_video}")
+        print(f"✅ Video rendered successfully: {output_video}")
         return output_video
 
+    except subprocess.CalledProcessError as e:
+        print(f"❌ FFmpeg Error: {e.stderr.decode('utf-8', errors='ignore')}")
+        return None
     except Exception as e:
-        print(f"❌ Error adding effects to video: {e}")
+        print(f"❌ Error rendering video: {e}")
         return None
 
-def generate_thumbnail(topic, output_file="thumbnail.jpg"):
-    print("🖼 Generating thumbnail using Pexels...")
+# رندر موازی قطعه‌ای: تایم‌لاین به قطعه‌های چند-GOPی تقسیم، هر قطعه جدا encode و در آخر بدون encode مجدد
+# با concat demuxer به هم وصل می‌شود. صدا فقط یک بار encode می‌شود.
+SEGMENTED_RENDER_MIN_SECONDS = 120
+RENDER_SEGMENT_WORKERS = int(os.getenv("RENDER_SEGMENT_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 2)
+RENDER_SEGMENT_RETRIES = 2
 
-    if not PEXELS_API_KEY:
-        print("❌ ERROR: Pexels API Key is missing! Set 'PEXELS_API_KEY' in environment variables.")
-        return None
+def plan_render_segments(duration, gop, workers=RENDER_SEGMENT_WORKERS):
+    """
+    تقسیم تایم‌لاین به قطعه‌هایی با طول مضربی از GOP (به فریم)، حدود دو قطعه برای هر worker
+    تا بار متعادل بماند و تکرار یک قطعه‌ی خراب ارزان باشد. خروجی: [(start_frame, frames)].
+    """
+    total_frames = int(round(duration * RENDER_FPS))
+    per_segment = -(-total_frames // max(1, workers * 2))
+    per_segment = max(gop, -(-per_segment // gop) * gop)
+    return [(start, min(per_segment, total_frames - start)) for start in range(0, total_frames, per_segment)]
+
+def build_segment_command(background_video, output_file, video_filters, start_frame, frames, preset="ultrafast",
+                          threads=2, crf=None, gop=None):
+    """
+    encode یک قطعه‌ی بی‌صدا. setpts زمان قطعه را به زمان کل ویدیو می‌برد تا عنوان‌ها و زیرنویس‌ها
+    (که با t زمان‌بندی شده‌اند) درست نمایش داده شوند، و بعد دوباره از صفر شروع می‌شود.
+    """
+    start = start_frame / RENDER_FPS
+    filter_chain = ",".join([f"setpts=PTS-STARTPTS+{start:.6f}/TB", *video_filters, "setpts=PTS-STARTPTS"])
+    return [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-ss", f"{start:.6f}",
+        "-i", background_video,
+        "-filter_complex", f"[0:v]{filter_chain}[v]",
+        "-map", "[v]", "-an",
+        "-r", str(RENDER_FPS), "-frames:v", str(frames),
+        "-c:v", "libx264", "-preset", preset, "-threads", str(threads),
+        *(["-crf", str(crf)] if crf is not None else []),
+        *(["-g", str(gop)] if gop else []),
+        "-video_track_timescale", str(RENDER_FPS * 512),
+        output_file
+    ]
+
+def _encode_segment(index, command, segment_file):
+    """ encode یک قطعه با تلاش مجدد؛ خروجی فقط بعد از موفقیت با os.replace در جای نهایی قرار می‌گیرد """
+    partial_file = command[-1]
+    for attempt in range(RENDER_SEGMENT_RETRIES + 1):
+        try:
+            _run_ffmpeg(command)
+            os.replace(partial_file, segment_file)
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"⚠ Segment {index} failed (attempt {attempt + 1}): {e.stderr.decode('utf-8', errors='ignore').strip()}")
+    return False
+
+def render_video_segmented(voiceover, background_video, output_video="final_video.mp4", overlays=VIDEO_OVERLAYS,
+                           sample_rate=BARK_SAMPLE_RATE, subtitles_file=None, profile=VIDEO_QUALITY, preset=None,
+                           deadline=None, workers=RENDER_SEGMENT_WORKERS):
+    """
+    همان خروجی render_video، اما تصویر در قطعه‌های هم‌تراز با GOP روی چند پردازه‌ی ffmpeg encode می‌شود.
+    قطعه‌ی خراب در همان اجرا دوباره encode می‌شود؛ پوشه‌ی موقت "<output>.segments" در هر حالت (موفق یا ناموفق) پاک می‌شود.
+    """
+    duration = len(voiceover) / sample_rate
+    profile, frame_size = fit_encode_profile(profile, background_video)
+    speed_key = f"{profile}{SEGMENTED_SPEED_SUFFIX}"
+    settings = encode_settings(profile, duration, deadline, preset, threads=max(1, (os.cpu_count() or 1) // workers),
+                               frame_size=frame_size, speed_key=speed_key)
+    plan = plan_render_segments(duration, settings["gop"] or RENDER_FPS * 2, workers)
+    print(f"🎬 Rendering final video in {len(plan)} parallel segments on {workers} workers...")
+
+    # قطعه‌ها کنار خروجی (نه در /tmp) ساخته می‌شوند، چون برای 4K چند گیگابایت جا می‌گیرند
+    segments_dir = f"{os.path.splitext(output_video)[0]}.segments"
+    shutil.rmtree(segments_dir, ignore_errors=True)  # باقی‌مانده‌ی اجرایی که وسط کار kill شده
+    os.makedirs(segments_dir)
+    video_filters = _render_video_filters(segments_dir, overlays, subtitles_file, settings["frame_size"])
+    segment_files = [os.path.join(segments_dir, f"segment_{i:04d}.mp4") for i in range(len(plan))]
+
+    def encode(i):
+        start_frame, frames = plan[i]
+        command = build_segment_command(background_video, f"{segment_files[i]}.partial.mp4", video_filters,
+                                        start_frame, frames, settings["preset"], settings["threads"],
+                                        settings["crf"], settings["gop"])
+        return _encode_segment(i, command, segment_files[i])
+
+    audio_file = os.path.join(segments_dir, "audio.m4a")
+    started = monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="segment") as executor:
+            futures = [executor.submit(encode, i) for i in range(len(plan))]
+
+            # صدا یک بار و همزمان با قطعه‌های تصویر encode می‌شود
+            _run_ffmpeg([
+                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                *_pcm_input_args(sample_rate),
+                "-af", ",".join(_render_audio_filters(duration)),
+                "-c:a", "aac", "-b:a", "192k",
+                audio_file
+            ], pcm=voiceover)
+
+            if not all(future.result() for future in futures):
+                print(f"❌ Some segments failed after {RENDER_SEGMENT_RETRIES} retries.")
+                return None
+
+        concat_list = os.path.join(segments_dir, "segments.txt")
+        with open(concat_list, "w", encoding="utf-8") as f:
+            f.writelines(f"file '{os.path.basename(path)}'\n" for path in segment_files)
+
+        _run_ffmpeg([
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", concat_list,
+            "-i", audio_file,
+            "-map", "0:v", "-map", "1:a",
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-t", f"{duration:.3f}",
+            output_video
+        ])
+        record_encode_speed(speed_key, settings["preset"], duration, monotonic() - started,
+                            frame_size=settings["frame_size"])
+
+        if not os.path.isfile(output_video):
+            print("❌ Error: Rendered video file not created.")
+            return None
+
+        print(f"✅ Video rendered successfully: {output_video}")
+        return output_video
+
+    except subprocess.CalledProcessError as e:
+        print(f"❌ FFmpeg Error: {e.stderr.decode('utf-8', errors='ignore')}")
+        return None
+    except Exception as e:
+        print(f"❌ Error rendering video: {e}")
+        return None
+    finally:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+# Shorts از همان صدا و پس‌زمینه‌ی ویدیوی بلند ساخته می‌شود؛ بدون فراخوانی دوباره‌ی LLM یا Bark
+SHORTS_ENABLED = os.getenv("SHORTS", "1") == "1"
+SHORTS_FRAME_SIZE = ENCODE_PROFILES["shorts"]["size"]
+SHORTS_HOOK_BONUS = 1.15  # پنجره‌ای که با hook متن شروع شود کمی ترجیح دارد
+# عنوان‌های Shorts برای عرض ۱۰۸۰ پیکسل؛ اندازه‌های VIDEO_OVERLAYS برای عرض ۱۹۲۰ است و در قاب عمودی بریده می‌شود
+SHORTS_OVERLAYS = [
+    {**overlay, "fontsize": round(overlay["fontsize"] * 0.7), "border": max(1, round(overlay["border"] * 0.7))}
+    for overlay in VIDEO_OVERLAYS
+]
+
+def select_short_window(audio, segments, sample_rate=BARK_SAMPLE_RATE, duration=SHORTS_DURATION):
+    """
+    انتخاب بهترین پنجره‌ی حداکثر duration ثانیه‌ای: پنجره‌ها روی مرز جمله‌ها (segments) شروع و تمام می‌شوند
+    و بر اساس انرژی صدا (RMS) و میزان پر بودن پنجره امتیاز می‌گیرند.
+    خروجی: (start, end) به نمونه.
+    """
+    limit = int(duration * sample_rate)
+    if len(audio) <= limit or not segments:
+        return 0, min(len(audio), limit)
+
+    # انرژی تجمعی روی فریم‌های ۱۰ میلی‌ثانیه‌ای تا محاسبه‌ی هر پنجره O(1) باشد
+    frame = max(1, sample_rate // 100)
+    usable = len(audio) // frame * frame
+    frame_energy = np.mean(np.square(audio[:usable].reshape(-1, frame)), axis=1, dtype=np.float64)
+    cumulative = np.concatenate([[0.0], np.cumsum(frame_energy)])
+
+    best = None
+    for i, segment in enumerate(segments):
+        start = segment["start"]
+        end = start
+        for following in segments[i:]:
+            if following["end"] - start > limit:
+                break
+            end = following["end"]
+        if end == start:
+            end = min(len(audio), start + limit)  # یک جمله‌ی خیلی بلند: برش وسط جمله
+
+        first, last = start // frame, max(start // frame + 1, min(end // frame, len(frame_energy)))
+        rms = np.sqrt((cumulative[last] - cumulative[first]) / (last - first))
+        score = rms * (end - start) / limit * (SHORTS_HOOK_BONUS if i == 0 else 1.0)
+        if best is None or score > best[0]:
+            best = (score, start, end)
+
+    return best[1], best[2]
+
+def render_short(voiceover, background_video, segments=None, output_video=SHORT_VIDEO_FILE,
+                 overlays=SHORTS_OVERLAYS, sample_rate=BARK_SAMPLE_RATE, threads=None, deadline=None):
+    """
+    رندر یک Short عمودی ۱۰۸۰×۱۹۲۰ از بهترین بخش ویدیوی بلند در یک اجرای ffmpeg (پروفایل "shorts").
+    پس‌زمینه همان خط زمانی صدا را دارد، پس فقط از همان نقطه seek می‌شود.
+    """
+    if not os.path.isfile(background_video):
+        print(f"❌ Error: Background video file not found ({background_video})")
+        return None
+
+    start, end = select_short_window(voiceover, segments, sample_rate)
+    clip = voiceover[start:end]
+    print(f"📱 Rendering a {len(clip) / sample_rate:.1f}s Short from {start / sample_rate:.1f}s...")
+
+    ass_file = None
+    if SUBTITLES_ENABLED and segments:
+        short_segments = [{"text": seg["text"], "start": seg["start"] - start, "end": min(seg["end"], end) - start}
+                          for seg in segments if start <= seg["start"] < end]
+        _, ass_file = generate_subtitles(clip, short_segments, f"{os.path.splitext(output_video)[0]}.srt",
+                                         sample_rate, play_res=SHORTS_FRAME_SIZE)
+
+    duration = len(clip) / sample_rate
+    profile, frame_size = fit_encode_profile("shorts", background_video)
+    settings = encode_settings(profile, duration, deadline, threads=threads, frame_size=frame_size)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="render_") as work_dir:
+            command = build_render_command(background_video, output_video, work_dir, duration=duration,
+                                           overlays=overlays, sample_rate=sample_rate, subtitles_file=ass_file,
+                                           background_offset=start / sample_rate, **settings)
+            started = monotonic()
+            _run_ffmpeg(command, pcm=clip)
+            record_encode_speed(profile, settings["preset"], duration, monotonic() - started,
+                                frame_size=settings["frame_size"])
+
+        if not os.path.isfile(output_video):
+            print("❌ Error: Short video file not created.")
+            return None
+
+        print(f"✅ Short rendered successfully: {output_video}")
+        return output_video
+
+    except subprocess.CalledProcessError as e:
+        print(f"❌ FFmpeg Error: {e.stderr.decode('utf-8', errors='ignore')}")
+        return None
+    except Exception as e:
+        print(f"❌ Error rendering Short: {e}")
+        return None
+
+# موتور تامبنیل: جستجو و عکس‌های Pexels روی دیسک کش می‌شوند، فونت‌ها یک بار در هر پردازه بارگذاری می‌شوند
+# و چند نسخه‌ی A/B از یک تصویر decode شده ساخته می‌شود
+THUMBNAIL_CACHE_DIR = os.getenv("THUMBNAIL_CACHE_DIR", "thumbnail_cache")
+THUMBNAIL_QUERY_TTL = 7 * 24 * 3600
+THUMBNAIL_SIZE = (1280, 720)  # اندازه‌ی پیشنهادی یوتیوب
+THUMBNAIL_FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "impact.ttf")  # فونت اینستاگرامی معروف
+THUMBNAIL_MARGIN = 60
+THUMBNAIL_VARIANTS = [
+    {"name": "bottom_yellow", "position": "bottom", "fill": "yellow", "stroke": "black", "max_lines": 2, "dim": 0.0},
+    {"name": "top_white", "position": "top", "fill": "white", "stroke": "black", "max_lines": 2, "dim": 0.15},
+    {"name": "center_red", "position": "center", "fill": "#ff3b30", "stroke": "white", "max_lines": 3, "dim": 0.4,
+     "upper": True}
+]
+
+@lru_cache(maxsize=64)
+def load_font(size, font_path=THUMBNAIL_FONT):
+    """ فونت با اندازه‌ی مشخص؛ هر ترکیب فقط یک بار از دیسک خوانده می‌شود """
+    try:
+        return ImageFont.truetype(font_path, size)
+    except OSError:
+        print("⚠️ Font not found, using default font.")
+        return ImageFont.load_default()
+
+def search_pexels_photo(query):
+    """ اولین عکس Pexels برای query؛ نتیجه‌ی جستجو تا THUMBNAIL_QUERY_TTL روی دیسک کش می‌شود """
+    cache_file = os.path.join(THUMBNAIL_CACHE_DIR, "queries",
+                              f"{hashlib.sha256(query.lower().encode('utf-8')).hexdigest()}.json")
+    cached = _read_json_file(cache_file, None)
+    if cached and datetime.now(timezone.utc).timestamp() - cached["created"] < THUMBNAIL_QUERY_TTL:
+        return cached["photo"]
+
+    if not PEXELS_API_KEY:
+        print("❌ ERROR: Pexels API Key is missing! Set 'PEXELS_API_KEY' in environment variables.")
+        return None
 
     # 🔍 جستجوی تصویر مرتبط در Pexels
     headers = {"Authorization": PEXELS_API_KEY}
-    params = {"query": topic, "per_page": 1}
-    response = requests.get(PEXELS_URL, headers=headers, params=params)
+    params = {"query": query, "per_page": 1, "orientation": "landscape"}
+    try:
+        response = requests.get(PEXELS_URL, headers=headers, params=params, timeout=15)
+    except requests.RequestException as e:
+        print(f"❌ ERROR: Failed to fetch image from Pexels: {e}")
+        return None
 
     if response.status_code != 200:
         print("❌ ERROR: Failed to fetch image from Pexels!")
         return None
 
-    data = response.json()
-    if "photos" not in data or len(data["photos"]) == 0:
-        print("⚠ No images found for this topic. Using default image.")
-        return None
+    photos = response.json().get("photos") or []
+    photo = None
+    if photos:
+        src = photos[0]["src"]
+        photo = {"id": photos[0]["id"], "url": src.get("large2x") or src["large"]}
 
-    image_url = data["photos"][0]["src"]["large"]
-    
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    _write_json_atomic(cache_file, {"created": datetime.now(timezone.utc).timestamp(), "photo": photo})
+    return photo
+
+def fetch_pexels_photo(photo):
+    """ فایل محلی عکس؛ هر photo ID فقط یک بار دانلود می‌شود """
+    path = os.path.join(THUMBNAIL_CACHE_DIR, "photos", f"{photo['id']}.jpg")
+    if os.path.isfile(path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
     # 📥 دانلود تصویر
-    img = Image.open(requests.get(image_url, stream=True).raw)
+    return download_file(photo["url"], path)
 
-    # 🖌 اضافه کردن متن روی تصویر
+def fit_text(draw, text, box_width, box_height, max_lines=2, max_size=140, min_size=40, stroke_ratio=0.06):
+    """
+    بزرگ‌ترین اندازه‌ی فونتی که متن (با شکستن خط بین کلمه‌ها) در کادر جا شود.
+    خروجی: (font, متن چندخطی، ضخامت استروک)
+    """
+    words = text.split()
+    for size in range(max_size, min_size - 1, -6):
+        font = load_font(size)
+        stroke = max(2, int(size * stroke_ratio))
+        lines = []
+        for word in words:
+            candidate = f"{lines[-1]} {word}" if lines else word
+            if lines and draw.textlength(candidate, font=font) + 2 * stroke <= box_width:
+                lines[-1] = candidate
+            else:
+                lines.append(word)
+
+        wrapped = "\n".join(lines)
+        left, top, right, bottom = draw.multiline_textbbox((0, 0), wrapped, font=font, stroke_width=stroke,
+                                                           align="center")
+        if len(lines) <= max_lines and right - left <= box_width and bottom - top <= box_height:
+            return font, wrapped, stroke
+
+    font = load_font(min_size)
+    return font, "\n".join(words), max(2, int(min_size * stroke_ratio))
+
+def render_thumbnail_variant(base, text, variant):
+    """ یک نسخه از تامبنیل روی کپی تصویر پایه (تصویر دوباره decode نمی‌شود) """
+    img = base.copy()
+    if variant.get("dim"):
+        img = Image.blend(img, Image.new("RGB", img.size, "black"), variant["dim"])
+
+    # 🖌 اضافه کردن متن روی تصویر با استروک واقعی برای خوانایی بهتر
     draw = ImageDraw.Draw(img)
-    FONT_PATH = os.path.join(os.path.dirname(__file__), "impact.ttf")
-    try:
-        font = ImageFont.truetype(FONT_PATH, 90)  # فونت اینستاگرامی معروف
-    except OSError:
-        print("⚠️ Font not found, using default font.")
-        font = ImageFont.load_default()
-    
-    text_position = (100, img.height - 150)
-    
-    # 🖌 افکت استروک برای خوانایی بهتر
-    for offset in range(-3, 4, 2):
-        draw.text((text_position[0] + offset, text_position[1]), topic, font=font, fill="black")
-        draw.text((text_position[0], text_position[1] + offset), topic, font=font, fill="black")
+    text = text.upper() if variant.get("upper") else text
+    box_width = img.width - 2 * THUMBNAIL_MARGIN
+    box_height = img.height // 2 - THUMBNAIL_MARGIN
+    font, wrapped, stroke = fit_text(draw, text, box_width, box_height, variant.get("max_lines", 2))
+
+    left, top, right, bottom = draw.multiline_textbbox((0, 0), wrapped, font=font, stroke_width=stroke, align="center")
+    x = (img.width - (right - left)) / 2 - left
+    if variant["position"] == "top":
+        y = THUMBNAIL_MARGIN - top
+    elif variant["position"] == "center":
+        y = (img.height - (bottom - top)) / 2 - top
+    else:
+        y = img.height - THUMBNAIL_MARGIN - bottom
 
-    draw.text(text_position, topic, font=font, fill="yellow")
+    draw.multiline_text((x, y), wrapped, font=font, fill=variant["fill"], stroke_width=stroke,
+                        stroke_fill=variant["stroke"], align="center")
+    return img
 
-    # 💾 ذخیره‌ی تامبنیل نهایی
-    img.save(output_file)
-    print(f"✅ Thumbnail saved as {output_file}")
-    return output_file
+def generate_thumbnail_variants(topic, output_file="thumbnail.jpg", variants=THUMBNAIL_VARIANTS):
+    """
+    ساخت چند نسخه‌ی A/B از تامبنیل با یک جستجو، یک دانلود و یک decode.
+    نسخه‌ی اول در output_file و بقیه در "<name>_<variant>.jpg" ذخیره می‌شوند. خروجی: لیست مسیرها.
+    """
+    print("🖼 Generating thumbnails using Pexels...")
 
-YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")  # باید API Key ست بشه
+    photo = search_pexels_photo(topic)
+    if not photo:
+        print("⚠ No images found for this topic. Using default image.")
+        return []
 
-def analyze_past_videos():
-    print("📊 Analyzing past video performance...")
+    image_file = fetch_pexels_photo(photo)
+    if not image_file:
+        print("❌ ERROR: Failed to download the Pexels image!")
+        return []
 
-    if not YOUTUBE_API_KEY:
-        print("❌ ERROR: YouTube API Key is missing! Set 'YOUTUBE_API_KEY' in environment variables.")
-        return None
+    try:
+        with Image.open(image_file) as img:
+            base = ImageOps.fit(img.convert("RGB"), THUMBNAIL_SIZE, Image.LANCZOS)
+
+        root, ext = os.path.splitext(output_file)
+        outputs = []
+        for i, variant in enumerate(variants):
+            path = output_file if i == 0 else f"{root}_{variant['name']}{ext}"
+            # 💾 ذخیره‌ی تامبنیل نهایی
+            render_thumbnail_variant(base, topic, variant).save(path, quality=92)
+            outputs.append(path)
+    except (OSError, ValueError) as e:
+        print(f"❌ Error rendering thumbnails: {e}")
+        return []
 
-    # دریافت اطلاعات کانال (بدون نیاز به CHANNEL_ID)
-    channel_url = f"https://www.googleapis.com/youtube/v3/channels?part=contentDetails&mine=true&key={YOUTUBE_API_KEY}"
-    channel_response = requests.get(channel_url)
+    print(f"✅ {len(outputs)} thumbnail variants saved: {', '.join(outputs)}")
+    return outputs
+
+def generate_thumbnail(topic, output_file="thumbnail.jpg"):
+    """ تامبنیل اصلی (نسخه‌ی اول generate_thumbnail_variants) """
+    variants = generate_thumbnail_variants(topic, output_file)
+    return variants[0] if variants else None
 
-    if channel_response.status_code != 200:
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")  # باید API Key ست بشه
+
+# پایگاه داده‌ی محلی آمار کانال؛ هر اجرا فقط ویدیوهای جدید و آمارهای احتمالاً تغییرکرده را می‌گیرد
+ANALYTICS_DB = os.getenv("ANALYTICS_DB", "analytics.sqlite")
+ANALYTICS_RECENT_DAYS = 30  # آمار ویدیوهای جدیدتر از این سریع‌تر تغییر می‌کند
+ANALYTICS_RECENT_REFRESH_HOURS = 6
+ANALYTICS_OLD_REFRESH_HOURS = 24 * 7
+YOUTUBE_API_BASE = "https://www.googleapis.com/youtube/v3"
+
+def _analytics_connect():
+    conn = sqlite3.connect(ANALYTICS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS videos (
+            video_id TEXT PRIMARY KEY,
+            published_at TEXT,
+            title TEXT,
+            views INTEGER,
+            likes INTEGER,
+            comments INTEGER,
+            stats_fetched_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """)
+    return conn
+
+def _analytics_meta(conn, key, value=None):
+    if value is None:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def _uploads_playlist_id(conn):
+    playlist_id = _analytics_meta(conn, "uploads_playlist_id")
+    if playlist_id:
+        return playlist_id
+
+    # دریافت اطلاعات کانال (بدون نیاز به CHANNEL_ID)؛ mine=true به OAuth نیاز دارد
+    response = youtube_request("GET", "channels.list", f"{YOUTUBE_API_BASE}/channels",
+                               params={"part": "contentDetails", "mine": "true"}, headers=_youtube_auth_headers())
+    if response is None or response.status_code != 200:
         print("❌ ERROR: Failed to fetch channel details!")
         return None
 
-    uploads_playlist_id = channel_response.json()["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
+    playlist_id = response.json()["items"][0]["contentDetails"]["relatedPlaylists"]["uploads"]
+    _analytics_meta(conn, "uploads_playlist_id", playlist_id)
+    return playlist_id
 
-    # دریافت لیست ویدیوها از آپلودهای کانال
-    url = f"https://www.googleapis.com/youtube/v3/playlistItems?part=contentDetails&playlistId={uploads_playlist_id}&maxResults=20&key={YOUTUBE_API_KEY}"
-    response = requests.get(url)
+def _sync_uploads_playlist(conn, playlist_id):
+    """
+    صفحه‌به‌صفحه خواندن لیست آپلودها (جدیدترین اول). اگر صفحه‌ی اول تغییری نکرده باشد (304)
+    یا به ویدیوهای از قبل شناخته‌شده برسیم، صفحه‌بندی متوقف می‌شود.
+    """
+    known = {row["video_id"] for row in conn.execute("SELECT video_id FROM videos")}
+    complete = _analytics_meta(conn, "uploads_complete") == "1"  # آیا یک بار کل لیست تا انتها خوانده شده؟
+    new_videos = []
+    page_token = None
+    first_page = True
+
+    while True:
+        params = {"part": "contentDetails", "playlistId": playlist_id, "maxResults": 50, "key": YOUTUBE_API_KEY}
+        headers = {}
+        if page_token:
+            params["pageToken"] = page_token
+        elif complete and _analytics_meta(conn, "uploads_etag"):
+            headers["If-None-Match"] = _analytics_meta(conn, "uploads_etag")
+
+        response = youtube_request("GET", "playlistItems.list", f"{YOUTUBE_API_BASE}/playlistItems", params=params, headers=headers)
+        if response is None:
+            break
+        if response.status_code == 304:
+            break
+        if response.status_code != 200:
+            print("❌ ERROR: Failed to fetch video list from YouTube!")
+            break
 
-    if response.status_code != 200:
-        print("❌ ERROR: Failed to fetch video list from YouTube!")
-        return None
+        data = response.json()
+        if first_page:
+            _analytics_meta(conn, "uploads_etag", data.get("etag", ""))
+            first_page = False
+
+        page = [(item["contentDetails"]["videoId"], item["contentDetails"].get("videoPublishedAt")) for item in data.get("items", [])]
+        fresh = [video for video in page if video[0] not in known]
+        new_videos.extend(fresh)
+
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            _analytics_meta(conn, "uploads_complete", "1")
+            break
+        if complete and len(fresh) < len(page):
+            break
+
+    conn.executemany("INSERT OR IGNORE INTO videos (video_id, published_at) VALUES (?, ?)", new_videos)
+    return len(new_videos)
+
+def _stale_video_ids(conn):
+    """ویدیوهای جدید، ویدیوهای اخیر با آمار قدیمی‌تر از چند ساعت و بقیه با آمار قدیمی‌تر از یک هفته."""
+    now = datetime.now(timezone.utc)
+    recent_cutoff = (now - timedelta(days=ANALYTICS_RECENT_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    rows = conn.execute("""
+        SELECT video_id FROM videos
+        WHERE stats_fetched_at IS NULL
+           OR (published_at >= ? AND stats_fetched_at < ?)
+           OR stats_fetched_at < ?
+        ORDER BY published_at DESC
+    """, (recent_cutoff,
+          now.timestamp() - ANALYTICS_RECENT_REFRESH_HOURS * 3600,
+          now.timestamp() - ANALYTICS_OLD_REFRESH_HOURS * 3600))
+    return [row["video_id"] for row in rows]
+
+def _refresh_video_stats(conn, video_ids):
+    """
+    videos.list در دسته‌های ۵۰تایی با If-None-Match. دسته‌ها روی کل لیست ویدیوها به ترتیب ثابت درج (rowid)
+    ساخته می‌شوند تا ترکیب هر دسته و در نتیجه ETag آن بین اجراها تکرار شود؛ فقط دسته‌هایی که ویدیوی
+    قدیمی (video_ids) دارند درخواست می‌شوند و ETag دسته‌هایی که دیگر وجود ندارند پاک می‌شود.
+    """
+    updated = 0
+    now = datetime.now(timezone.utc).timestamp()
+    stale = set(video_ids)
+
+    all_ids = [row["video_id"] for row in conn.execute("SELECT video_id FROM videos ORDER BY rowid")]
+    batches = {"batch_etag:" + hashlib.sha1(",".join(all_ids[i:i + 50]).encode()).hexdigest(): all_ids[i:i + 50]
+               for i in range(0, len(all_ids), 50)}
+    for (key,) in conn.execute("SELECT key FROM meta WHERE key LIKE 'batch_etag:%'").fetchall():
+        if key not in batches:
+            conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    for batch_key, batch in batches.items():
+        if stale.isdisjoint(batch):
+            continue
+        headers = {}
+        if _analytics_meta(conn, batch_key):
+            headers["If-None-Match"] = _analytics_meta(conn, batch_key)
+
+        response = youtube_request("GET", "videos.list", f"{YOUTUBE_API_BASE}/videos", params={
+            "part": "snippet,statistics", "id": ",".join(batch), "key": YOUTUBE_API_KEY
+        }, headers=headers)
+
+        if response is None:
+            break
+        if response.status_code == 304:
+            conn.execute(f"UPDATE videos SET stats_fetched_at = ? WHERE video_id IN ({','.join('?' * len(batch))})", [now, *batch])
+            continue
+        if response.status_code != 200:
+            print("❌ ERROR: Failed to fetch video stats!")
+            continue
 
-    video_ids = [item["contentDetails"]["videoId"] for item in response.json().get("items", [])]
+        data = response.json()
+        _analytics_meta(conn, batch_key, data.get("etag", ""))
+        rows = []
+        for video in data.get("items", []):
+            stats = video.get("statistics", {})
+            rows.append((
+                video["snippet"].get("title"),
+                video["snippet"].get("publishedAt"),
+                int(stats.get("viewCount", 0)),
+                int(stats.get("likeCount", 0)),
+                int(stats.get("commentCount", 0)),
+                now,
+                video["id"]
+            ))
+        conn.executemany("""
+            UPDATE videos SET title = ?, published_at = COALESCE(?, published_at),
+                              views = ?, likes = ?, comments = ?, stats_fetched_at = ?
+            WHERE video_id = ?
+        """, rows)
+        updated += len(rows)
+
+    return updated
+
+def refresh_channel_analytics():
+    """ به‌روزرسانی تدریجی پایگاه داده‌ی آمار کانال """
+    with closing(_analytics_connect()) as conn, conn:
+        playlist_id = _uploads_playlist_id(conn)
+        if not playlist_id:
+            return False
 
-    if not video_ids:
-        print("⚠ No videos found.")
-        return None
+        new_count = _sync_uploads_playlist(conn, playlist_id)
+        stale_ids = _stale_video_ids(conn)
+        updated = _refresh_video_stats(conn, stale_ids)
 
-    # دریافت آمار ویدیوها
-    stats_url = f"https://www.googleapis.com/youtube/v3/videos?part=statistics&id={','.join(video_ids)}&key={YOUTUBE_API_KEY}"
-    stats_response = requests.get(stats_url)
+    print(f"✅ Analytics store updated: {new_count} new videos, {updated} stats refreshed.")
+    return True
 
-    if stats_response.status_code != 200:
-        print("❌ ERROR: Failed to fetch video stats!")
+def analyze_past_videos(top_n=5):
+    print("📊 Analyzing past video performance...")
+
+    if not YOUTUBE_API_KEY:
+        print("❌ ERROR: YouTube API Key is missing! Set 'YOUTUBE_API_KEY' in environment variables.")
         return None
 
-    stats_data = stats_response.json().get("items", [])
+    try:
+        refresh_channel_analytics()
+    except Exception as e:
+        print(f"⚠ Could not refresh analytics, using stored data: {e}")
 
-    engagement_data = []
-    for video in stats_data:
-        vid_id = video["id"]
-        stats = video["statistics"]
+    with closing(_analytics_connect()) as conn:
+        rows = conn.execute("SELECT video_id, views, likes, comments FROM videos WHERE stats_fetched_at IS NOT NULL").fetchall()
 
-        likes = int(stats.get("likeCount", 0))
-        comments = int(stats.get("commentCount", 0))
-        views = int(stats.get("viewCount", 1))  # جلوگیری از تقسیم بر صفر
+    if not rows:
+        print("⚠ No videos found.")
+        return None
 
-        engagement_rate = (likes + comments) / views
-        engagement_data.append((vid_id, engagement_rate))
+    # محاسبه‌ی نرخ تعامل برای کل تاریخچه به صورت برداری
+    video_ids = np.array([row["video_id"] for row in rows])
+    stats = np.array([(row["views"] or 0, row["likes"] or 0, row["comments"] or 0) for row in rows], dtype=np.float64)
+    views = np.maximum(stats[:, 0], 1)  # جلوگیری از تقسیم بر صفر
+    engagement_rates = (stats[:, 1] + stats[:, 2]) / views
 
-    best_videos = sorted(engagement_data, key=lambda x: x[1], reverse=True)
+    top = np.argsort(-engagement_rates, kind="stable")[:top_n]
+    best_videos = [(str(video_ids[i]), float(engagement_rates[i])) for i in top]
 
+    print(f"\n📈 Channel history: {len(rows)} videos, median engagement {np.median(engagement_rates):.2%}")
     print("\n🔥 **Top Performing Videos:**")
-    for vid_id, rate in best_videos[:5]:
+    for vid_id, rate in best_videos:
         print(f"- Video ID: {vid_id}, Engagement Rate: {rate:.2%}")
 
-    return best_videos[:5]
+    return best_videos
 
 def suggest_improvements():
     
@@ -704,7 +2710,7 @@ def suggest_improvements():
         print("⚠ Not enough data to suggest improvements.")
         return
 
-    engagement_rates = [vid[1]["engagement_rate"] for vid in best_videos]
+    engagement_rates = [vid[1] for vid in best_videos]
     avg_engagement = sum(engagement_rates) / len(engagement_rates) if engagement_rates else 0
 
     print(f"\n📊 **Average Engagement Rate:** {avg_engagement:.2%}")
@@ -717,23 +2723,34 @@ def suggest_improvements():
         print("- Focus on topics similar to high-performing videos.")
         print("- Encourage more comments by asking interactive questions.")
         print("- Test different thumbnail styles (e.g., bold text, bright colors).")
-        
-    script= generate_video_script(topic)
+
+# دفتر محلی آپلودهای خودمان؛ شمارش آپلودهای امروز بدون هیچ فراخوانی API
+_upload_log_lock = threading.Lock()
+
+def log_upload(upload_type, video_id=None, title=None):
+    """ ثبت یک آپلود موفق در UPLOAD_LOG_FILE """
+    entry = {
+        "date": datetime.now(timezone.utc).isoformat()[:10],
+        "uploaded_at": datetime.now(timezone.utc).isoformat(),
+        "type": upload_type,
+        "video_id": video_id,
+        "title": title
+    }
+    with _upload_log_lock:
+        uploads = _read_json_file(UPLOAD_LOG_FILE, [])
+        uploads.append(entry)
+        _write_json_atomic(UPLOAD_LOG_FILE, uploads)
+    return entry
 
 def check_upload_limit():
     today = datetime.now(timezone.utc).isoformat()[:10]  # تاریخ امروز به فرمت YYYY-MM-DD
 
-    url = f"https://www.googleapis.com/youtube/v3/search?part=snippet&channelId={CHANNEL_ID}&maxResults=50&order=date&type=video&publishedAfter={today}T00:00:00Z&key={YOUTUBE_API_KEY}"
-    response = requests.get(url)
-
-    if response.status_code != 200:
-        print("❌ ERROR: Failed to fetch upload history from YouTube!")
-        return {"long_videos": 0, "shorts": 0}  # در صورت خطا، فرض می‌کنیم هیچ ویدیویی آپلود نشده
+    with _upload_log_lock:
+        uploads = _read_json_file(UPLOAD_LOG_FILE, [])
 
-    videos = response.json().get("items", [])
-
-    long_videos = sum(1 for v in videos if "shorts" not in v["snippet"]["title"].lower())  # تشخیص ویدیوهای عادی
-    shorts = sum(1 for v in videos if "shorts" in v["snippet"]["title"].lower())  # تشخیص YouTube Shorts
+    todays_uploads = [u for u in uploads if u.get("date") == today]
+    long_videos = sum(1 for u in todays_uploads if u.get("type") == "long_videos")
+    shorts = sum(1 for u in todays_uploads if u.get("type") == "shorts")
 
     return {"long_videos": long_videos, "shorts": shorts}
 
@@ -748,29 +2765,65 @@ def get_upload_type():
         return "shorts"  # زمان آپلود Shorts
     return None
 
+# کش access token: تا کمی قبل از انقضا (expires_in) دوباره استفاده می‌شود
+TOKEN_CACHE_FILE = os.getenv("TOKEN_CACHE_FILE")  # اختیاری؛ برای اشتراک توکن بین اجراها
+TOKEN_EXPIRY_MARGIN = 120  # ثانیه
+
+_token_cache = {"access_token": None, "expires_at": 0}
+_token_lock = threading.Lock()
+
+def _token_is_fresh(cache):
+    return bool(cache.get("access_token")) and cache.get("expires_at", 0) - TOKEN_EXPIRY_MARGIN > datetime.now(timezone.utc).timestamp()
+
 # دریافت access token
-def get_access_token():
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "refresh_token": REFRESH_TOKEN,
-        "grant_type": "refresh_token"
-    }
-    response = requests.post(TOKEN_URL, data=data)
-    response_json = response.json()
-    if response.status_code != 200 or "access_token" not in response_json:
-        raise Exception("Failed to get access token: " + str(response_json))
-    return response_json.get("access_token")
+def get_access_token(rejected_token=None):
+    """
+    توکن کش‌شده را برمی‌گرداند و فقط در صورت انقضا (یا رد شدن rejected_token با 401) آن را تازه می‌کند.
+    درخواست‌های همزمان منتظر همان یک refresh می‌مانند.
+    """
+    cached = _token_cache
+    if _token_is_fresh(cached) and cached["access_token"] != rejected_token:
+        return cached["access_token"]
+
+    with _token_lock:
+        # ممکن است thread دیگری در همین فاصله توکن را تازه کرده باشد
+        if _token_is_fresh(_token_cache) and _token_cache["access_token"] != rejected_token:
+            return _token_cache["access_token"]
+
+        if TOKEN_CACHE_FILE:
+            stored = _read_json_file(TOKEN_CACHE_FILE, {})
+            if _token_is_fresh(stored) and stored["access_token"] != rejected_token:
+                _token_cache.update(stored)
+                return stored["access_token"]
+
+        data = {
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+            "refresh_token": REFRESH_TOKEN,
+            "grant_type": "refresh_token"
+        }
+        response = requests.post(TOKEN_URL, data=data, timeout=30)
+        response_json = response.json()
+        if response.status_code != 200 or "access_token" not in response_json:
+            raise Exception("Failed to get access token: " + str(response_json))
 
-# آپلود متادیتا و دریافت video_id
-def upload_metadata(title, description, category_id=24, privacy_status="public"):
-    access_token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"part": "snippet,status"}
-    metadata = {
+        expires_at = datetime.now(timezone.utc).timestamp() + int(response_json.get("expires_in", 3600))
+        _token_cache.update({"access_token": response_json["access_token"], "expires_at": expires_at})
+
+        if TOKEN_CACHE_FILE:
+            try:
+                # فایل موقت از همان ابتدا فقط برای مالک قابل خواندن است
+                _write_json_atomic(TOKEN_CACHE_FILE, dict(_token_cache), mode=0o600)
+            except OSError as e:
+                print(f"⚠ Could not save token cache: {e}")
+
+        return _token_cache["access_token"]
+
+def _youtube_auth_headers():
+    return {"Authorization": f"Bearer {get_access_token()}"}
+
+def build_video_resource(title, description, category_id=24, privacy_status="public"):
+    return {
         "snippet": {
             "title": title,
             "description": description,
@@ -780,56 +2833,213 @@ def upload_metadata(title, description, category_id=24, privacy_status="public")
             "privacyStatus": privacy_status
         }
     }
-    metadata_response = requests.post(METADATA_URL, headers=headers, params=params, json=metadata)
+
+# آپلود متادیتا و دریافت video_id
+def upload_metadata(title, description, category_id=24, privacy_status="public"):
+    access_token = get_access_token()
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    params = {"part": "snippet,status"}
+    metadata = build_video_resource(title, description, category_id, privacy_status)
+    metadata_response = youtube_request("POST", "videos.insert", METADATA_URL, headers=headers, params=params, json=metadata)
+    if metadata_response is None:
+        return None
     if metadata_response.status_code != 200:
         print("Error uploading metadata:", metadata_response.json())
         return None
     return metadata_response.json().get("id")
 
-# آپلود ویدیو
-def upload_video(video_file, video_id):
-    if not isinstance(video_file, str) or not os.path.exists(video_file):
-        print(f"❌ ERROR: Invalid video file path: {video_file}")
-        return
+# آپلود قابل ادامه (resumable) در تکه‌های ثابت؛ اندازه‌ی تکه باید مضربی از 256KB باشد
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_MB", "16")) * 1024 * 1024
+UPLOAD_MAX_RETRIES = 8
+UPLOAD_SESSIONS_FILE = "upload_sessions.json"  # نشست‌های نیمه‌کاره تا اجرای بعدی هم قابل ادامه‌اند
 
-    access_token = get_access_token()
-    if not access_token:
-        print("❌ ERROR: Failed to retrieve access token.")
-        return
+def _upload_session_key(video_file):
+    stat = os.stat(video_file)
+    return f"{os.path.abspath(video_file)}:{stat.st_size}:{int(stat.st_mtime)}"
 
+def _remember_upload_session(video_file, session_url):
+    sessions = _read_json_file(UPLOAD_SESSIONS_FILE, {})
+    if session_url:
+        sessions[_upload_session_key(video_file)] = session_url
+    else:
+        sessions.pop(_upload_session_key(video_file), None)
+    _write_json_atomic(UPLOAD_SESSIONS_FILE, sessions)
+
+def _start_upload_session(video_file, file_size, access_token, metadata=None):
     headers = {
         "Authorization": f"Bearer {access_token}",
         "X-Upload-Content-Type": "video/mp4",
-        "X-Upload-Content-Length": str(os.path.getsize(video_file))
+        "X-Upload-Content-Length": str(file_size)
     }
 
-    init_request = requests.post(
+    init_request = youtube_request(
+        "POST", "videos.insert",
         f"{UPLOAD_URL}?uploadType=resumable&part=snippet,status",
-        headers=headers
+        headers=headers,
+        json=metadata
     )
+    if init_request is None:
+        return None
 
     if init_request.status_code != 200:
         print("❌ ERROR initializing upload:", init_request.text)
-        return
+        return None
 
     upload_url = init_request.headers.get("Location")
     if not upload_url:
         print("❌ ERROR: Failed to retrieve upload URL.")
-        return
+        return None
 
     print(f"✅ Upload URL obtained: {upload_url}")
+    return upload_url
+
+def _committed_offset(response):
+    """Next byte to send, from the Range header of a 308 Resume Incomplete response."""
+    range_header = response.headers.get("Range")
+    if not range_header:
+        return 0
+    return int(range_header.rsplit("-", 1)[1]) + 1
+
+def _query_upload_offset(upload_url, file_size, access_token):
+    """
+    پرسیدن وضعیت نشست: (offset, response). اگر آپلود تمام شده باشد offset برابر حجم فایل است
+    و اگر نشست منقضی شده باشد (None, response).
+    """
+    response = requests.put(upload_url, headers={
+        "Authorization": f"Bearer {access_token}",
+        "Content-Length": "0",
+        "Content-Range": f"bytes */{file_size}"
+    }, timeout=30)
+
+    if response.status_code in (200, 201):
+        return file_size, response
+    if response.status_code == 308:
+        return _committed_offset(response), response
+    if response.status_code in (404, 410):
+        return None, response
+    response.raise_for_status()
+    return None, response
+
+# آپلود ویدیو
+def upload_video(video_file, video_id=None, access_token=None, metadata=None):
+    """
+    آپلود تکه‌تکه با Content-Range. بعد از قطع اتصال یا خطای 5xx، offset ذخیره‌شده روی سرور
+    پرسیده و آپلود از همان نقطه با backoff نمایی ادامه داده می‌شود.
+    در صورت موفقیت منبع ویدیوی ساخته‌شده (dict) برگردانده می‌شود.
+    """
+    if not isinstance(video_file, str) or not os.path.exists(video_file):
+        print(f"❌ ERROR: Invalid video file path: {video_file}")
+        return None
+
+    access_token = access_token or get_access_token()
+    if not access_token:
+        print("❌ ERROR: Failed to retrieve access token.")
+        return None
+
+    file_size = os.path.getsize(video_file)
+    upload_url = _read_json_file(UPLOAD_SESSIONS_FILE, {}).get(_upload_session_key(video_file))
+    offset = 0
+
+    if upload_url:
+        try:
+            offset, _ = _query_upload_offset(upload_url, file_size, access_token)
+        except requests.RequestException:
+            offset = None
+        if offset is None:
+            upload_url, offset = None, 0
+        else:
+            print(f"🔁 Resuming previous upload session at {offset / file_size:.0%}.")
+
+    if not upload_url:
+        upload_url = _start_upload_session(video_file, file_size, access_token, metadata)
+        if not upload_url:
+            return None
+        _remember_upload_session(video_file, upload_url)
+
+    started = monotonic()
+    start_offset = offset
+    retries = 0
+    token_refreshed = False  # فقط یک تازه‌سازی اجباری توکن تا پیشرفت بعدی؛ 401 دوباره یعنی اعتبارنامه مشکل دارد
 
     with open(video_file, "rb") as file:
-        upload_response = requests.put(upload_url, headers={
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "video/mp4",
-            "Content-Length": str(os.path.getsize(video_file))
-        }, data=file)
-
-    if upload_response.status_code in [200, 201]:
-        print("✅ Video uploaded successfully!")
-    else:
-        print(f"❌ ERROR uploading video: {upload_response.text}")
+        while True:
+            if offset is None:
+                print("⚠ Upload session expired, starting a new one.")
+                upload_url = _start_upload_session(video_file, file_size, access_token, metadata)
+                if not upload_url:
+                    return None
+                _remember_upload_session(video_file, upload_url)
+                offset, start_offset = 0, 0
+
+            try:
+                if offset >= file_size:
+                    # همه‌ی بایت‌ها ارسال شده؛ پاسخ نهایی را از سرور می‌گیریم
+                    offset, response = _query_upload_offset(upload_url, file_size, access_token)
+                else:
+                    file.seek(offset)
+                    chunk = file.read(UPLOAD_CHUNK_BYTES)
+                    end = offset + len(chunk) - 1
+                    response = requests.put(upload_url, headers={
+                        "Authorization": f"Bearer {access_token}",
+                        "Content-Type": "video/mp4",
+                        "Content-Length": str(len(chunk)),
+                        "Content-Range": f"bytes {offset}-{end}/{file_size}"
+                    }, data=chunk, timeout=120)
+
+                if response.status_code in (200, 201):
+                    elapsed = max(monotonic() - started, 1e-6)
+                    print(f"✅ Video uploaded successfully! ({(file_size - start_offset) / 1e6 / elapsed:.1f} MB/s)")
+                    _remember_upload_session(video_file, None)
+                    return response.json()
+
+                if response.status_code == 308:
+                    offset = _committed_offset(response)
+                    retries = 0
+                    token_refreshed = False
+                    elapsed = max(monotonic() - started, 1e-6)
+                    print(f"⬆ Uploaded {offset / 1e6:.1f}/{file_size / 1e6:.1f} MB ({offset / file_size:.0%}), "
+                          f"{(offset - start_offset) / 1e6 / elapsed:.1f} MB/s")
+                    continue
+
+                if response.status_code == 401:
+                    if token_refreshed:
+                        print("❌ ERROR uploading video: access token was rejected again after a refresh.")
+                        return None
+                    access_token = get_access_token(rejected_token=access_token)
+                    if not access_token:
+                        print("❌ ERROR: Failed to refresh access token.")
+                        return None
+                    token_refreshed = True
+                    continue
+
+                if response.status_code in (404, 410) or offset is None:
+                    offset = None
+                    continue
+
+                if response.status_code < 500:
+                    print(f"❌ ERROR uploading video: {response.text}")
+                    return None
+
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+
+            # خطای موقت: صبر با backoff نمایی و سپس پرسیدن offset واقعی از سرور
+            retries += 1
+            if retries > UPLOAD_MAX_RETRIES:
+                print(f"❌ ERROR uploading video after {UPLOAD_MAX_RETRIES} retries: {error}")
+                return None
+
+            delay = min(60, 2 ** retries)
+            print(f"⚠ Upload interrupted ({error}), retrying in {delay}s...")
+            sleep(delay)
+            try:
+                offset, _ = _query_upload_offset(upload_url, file_size, access_token)
+            except requests.RequestException:
+                pass  # دوباره با همان offset امتحان می‌کنیم
 
 def check_copyright_violation(script):
     prompt = f"""
@@ -842,12 +3052,10 @@ def check_copyright_violation(script):
     """
     
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo-Free",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=250
-        )
-        result = response["choices"][0]["message"]["content"]
+        if get_together_client() is None:
+            return True  # بدون کلید API بررسی ممکن نیست
+
+        result = llm_complete(prompt, use_cache=True, max_tokens=250)
         
         if "SAFE" in result:
             return True
@@ -880,12 +3088,10 @@ def check_and_fix_youtube_metadata(video_metadata):
     """
 
     try:
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo-Free",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=300
-        )
-        result = response["choices"][0]["message"]["content"]
+        if get_together_client() is None:
+            return video_metadata
+
+        result = llm_complete(prompt, use_cache=True, max_tokens=300)
 
         if "SAFE" in result:
             print("✅ Metadata is safe.")
@@ -908,103 +3114,696 @@ def check_and_fix_youtube_metadata(video_metadata):
         print("❌ Error checking/fixing metadata:", str(e))
         return video_metadata  # اگر خطا پیش آمد، آپلود را متوقف نکن
 
-# استفاده از بررسی و اصلاح خودکار قبل از آپلود
-video_metadata = generate_video_metadata(topic)
-video_metadata = check_and_fix_youtube_metadata(video_metadata)
 
-upload_video(enhance_video, video_metadata)
+# مرحله‌ی LLM: یا یک فراخوانی ساختاریافته (JSON)، یا دو زنجیره‌ی مستقل (متن → کپی‌رایت، متادیتا → سیاست‌ها) به صورت موازی
+LLM_STRUCTURED = os.getenv("LLM_STRUCTURED", "1") == "1"
+YOUTUBE_TITLE_MAX_CHARS = 100
 
-# اجرای آپلود در زمان مناسب
-if __name__ == "__main__":
-    print("🚀 Starting the YouTube Auto-Upload Bot...")
+def default_video_metadata(topic):
+    return {
+        "title": f"Awesome Video About {topic}!",
+        "description": f"This video is all about {topic}. Stay tuned for more!",
+        "hashtags": "#YouTube #Trending"
+    }
 
-    # 1️⃣ تحلیل ویدیوهای قبلی و ارائه پیشنهادات برای بهینه‌سازی
-    suggest_improvements()
+def validate_video_package(data):
+    """
+    بررسی و نرمال‌سازی خروجی JSON حالت ساختاریافته. در صورت نامعتبر بودن ValueError می‌دهد.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Structured response is not a JSON object")
+
+    for key in ["script", "title", "description"]:
+        if not isinstance(data.get(key), str) or not data[key].strip():
+            raise ValueError(f"Missing or empty '{key}'")
+    for key in ["copyright_safe", "policy_safe"]:
+        if not isinstance(data.get(key), bool):
+            raise ValueError(f"'{key}' must be true or false")
+
+    hashtags = data.get("hashtags", "")
+    if isinstance(hashtags, list):
+        hashtags = " ".join(str(tag) for tag in hashtags)
+    if not isinstance(hashtags, str):
+        raise ValueError("'hashtags' must be a string or a list")
+
+    return {
+        "script": data["script"].strip(),
+        "metadata": {
+            "title": data["title"].strip()[:YOUTUBE_TITLE_MAX_CHARS],
+            "description": data["description"].strip(),
+            "hashtags": hashtags.strip()
+        },
+        "copyright_safe": data["copyright_safe"],
+        "copyright_notes": str(data.get("copyright_notes") or ""),
+        "policy_safe": data["policy_safe"]
+    }
 
-    # 2️⃣ دریافت و ذخیره‌ی ترندهای مختلف 
-    fetch_all_trends()
+def generate_structured_video(topic, use_cache=False):
+    """ متن، عنوان، توضیحات، هشتگ‌ها و نتیجه‌ی بررسی‌ها در یک فراخوانی JSON """
+    print("🧩 Generating script and metadata in one structured call...")
 
-    # 3️⃣ تحلیل داده‌های ترند و انتخاب بهترین موضوع
-    selected_topic = select_best_trending_topic(trends)
-    if not selected_topic:
-        print("⚠ No suitable topic found, skipping video creation.")
-        exit()  # اگر موضوع مناسبی پیدا نشود، اجرا متوقف می‌شود.
+    prompt = f"""
+    You are producing a YouTube video about "{topic}". Return ONE JSON object and nothing else, with these keys:
+
+    "script": a high-engagement, viral video script with a Hook (first 5-10 sec: a shocking fact, bold statement
+              or intriguing question), Main Content (70%, exciting and easy to understand, like a famous YouTuber)
+              and a natural Call to Action (last 10 sec). Fun, casual language, short dynamic sentences,
+              rhetorical questions and direct audience engagement.
+    "title": an eye-catching title optimized for high CTR (at most {YOUTUBE_TITLE_MAX_CHARS} characters).
+    "description": a short summary of the video with a call to action.
+    "hashtags": relevant hashtags separated by spaces.
+    "copyright_safe": true if the script is fully original and carries no copyright or plagiarism risk, else false.
+    "copyright_notes": a short explanation when copyright_safe is false, otherwise "".
+    "policy_safe": true if the title and description fully comply with YouTube's policies, else false.
+    """
 
-    print(f"🔥 Creating a video on: {selected_topic}")
+    try:
+        content = llm_complete(prompt, use_cache=use_cache, temperature=0.8, max_tokens=1200,
+                               response_format={"type": "json_object"},
+                               validate=lambda text: validate_video_package(parse_json_object(text)))
+        package = validate_video_package(parse_json_object(content))
+        print("✅ Structured script and metadata generated successfully!")
+        return package
+    except Exception as e:
+        print(f"❌ Structured generation failed: {e}")
+        return None
 
-    # 4️⃣ تولید متن ویدیوی جذاب با GPT
-    script = generate_video_script(selected_topic)
+def _script_chain(topic, use_cache):
+    script = generate_video_script(topic, use_cache)
     if not script:
         print("❌ Script generation failed. Skipping video creation.")
-        exit()
+        return None
 
     print("📜 Video script generated successfully!")
 
-    # 5️⃣ تولید صداگذاری از روی متن
-    voiceover = generate_voiceover(script)
-    if not voiceover:
-        print("❌ Voiceover generation failed. Skipping video creation.")
-        exit()
+    if not check_copyright_violation(script):
+        print("❌ Script failed the copyright check. Skipping video creation.")
+        return None
+    return script
 
-    # 6️⃣ تولید زیرنویس
-    subtitles = generate_subtitles(voiceover)
+def _metadata_chain(topic, use_cache):
+    video_metadata = generate_video_metadata(topic, use_cache) or default_video_metadata(topic)
+    # استفاده از بررسی و اصلاح خودکار قبل از آپلود
+    return check_and_fix_youtube_metadata(video_metadata)
 
-    # 7️⃣ تولید ویدیو نهایی
-    final_video = generate_video(voiceover, "minecraft_parkour.mp4")
-    if not final_video:
-        print("❌ Video generation failed.")
-        exit()
+def generate_video_package(topic, structured=LLM_STRUCTURED, use_cache=False):
+    """
+    متن و متادیتای بررسی‌شده‌ی یک ویدیو: {"script", "metadata"} یا None.
+    حالت ساختاریافته یک (و فقط در صورت نیاز به اصلاح متادیتا دو) رفت و برگشت دارد؛
+    اگر JSON نامعتبر باشد، فراخوانی‌های جداگانه به صورت موازی اجرا می‌شوند.
+    """
+    if structured:
+        package = generate_structured_video(topic, use_cache)
+        if package:
+            if not package["copyright_safe"]:
+                print(f"⚠ Potential copyright issue detected: {package['copyright_notes']}")
+                print("❌ Script failed the copyright check. Skipping video creation.")
+                return None
+
+            metadata = package["metadata"]
+            if not package["policy_safe"]:
+                metadata = check_and_fix_youtube_metadata(metadata)
+            return {"script": package["script"], "metadata": metadata}
+        print("⚠ Falling back to separate script and metadata calls.")
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm") as executor:
+        script_future = executor.submit(_script_chain, topic, use_cache)
+        metadata_future = executor.submit(_metadata_chain, topic, use_cache)
+        script = script_future.result()
+        metadata = metadata_future.result()
+
+    if not script:
+        return None
+    return {"script": script, "metadata": metadata}
 
-    print(f"🎬 Video ready for editing: {final_video}")
+# حالت streaming: جمله‌های متن همان لحظه که از مدل می‌رسند به Bark فرستاده می‌شوند
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
 
-    # 8️⃣ بهینه‌سازی صدا و تصویر
-    enhanced_voiceover = enhance_audio(voiceover)  # حذف نویز و بهینه‌سازی
-    enhanced_video = enhance_video(final_video)  # افزودن افکت‌های گرافیکی
+def stream_script_to_voiceover(topic, voice_preset=VOICE_PRESET, use_cache=False):
+    """
+    تولید متن به صورت stream و سنتز همزمان صدا؛ متادیتا موازی ساخته می‌شود و بررسی کپی‌رایت
+    به محض کامل شدن متن، همزمان با سنتز جمله‌های آخر اجرا می‌شود.
+    خروجی: {"script", "metadata", "voiceover", "segments"} یا None.
+    """
+    print("🌊 Streaming script generation into the voiceover engine...")
+    parts = []
 
-    # 9️⃣ تولید تامبنیل برای ویدیو
-    thumbnail = generate_thumbnail(selected_topic)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm") as executor:
+        metadata_future = executor.submit(_metadata_chain, topic, use_cache)
+        checks = {}
 
-    # 🔟 اضافه کردن افکت‌های گرافیکی به ویدیو
-    final_video_with_effects = add_video_effects(enhanced_video)
+        def script_deltas():
+            for delta in llm_stream(_video_script_prompt(topic), use_cache=use_cache, **VIDEO_SCRIPT_PARAMS):
+                parts.append(delta)
+                yield delta
+            checks["copyright"] = executor.submit(check_copyright_violation, "".join(parts).strip())
 
-    # 📝 تولید متادیتای ویدیو
-    video_metadata = generate_video_metadata(selected_topic)
-    if not video_metadata:
-        video_metadata = {
-            "title": f"Awesome Video About {selected_topic}!",
-            "description": f"This video is all about {selected_topic}. Stay tuned for more!",
-            "hashtags": "#YouTube #Trending"
-        }
+        try:
+            voiceover, segments = synthesize_voiceover_stream(iter_script_chunks(script_deltas()), voice_preset)
+        except Exception as e:
+            print(f"❌ API Request Error: {e}")
+            voiceover, segments = None, None
 
-    title = video_metadata["title"]
-    description = video_metadata["description"]
-    hashtags = video_metadata["hashtags"]
+        copyright_ok = checks["copyright"].result() if "copyright" in checks else False
+        metadata = metadata_future.result()
 
-    # 1️⃣1️⃣ آپلود متادیتای ویدیو و دریافت video_id
-    video_id = upload_metadata(title, description, category_id=20, privacy_status="public")
-    if not video_id:
-        print("❌ Failed to upload metadata, skipping video upload.")
-        exit()
+    script = "".join(parts).strip()
+    if voiceover is None:
+        print("❌ Script or voiceover generation failed. Skipping video creation.")
+        return None
+    if not copyright_ok:
+        print("❌ Script failed the copyright check. Skipping video creation.")
+        return None
 
-    # 1️⃣2️⃣ آپلود ویدیوی نهایی
-    upload_video(final_video_with_effects, video_id)
+    print("📜 Video script generated successfully!")
+    return {"script": script, "metadata": metadata, "voiceover": voiceover, "segments": segments}
+
+# زمان‌بندی: مدت هر مرحله اندازه‌گیری و برای شروع به‌موقع رندر پیش از زمان آپلود استفاده می‌شود
+STAGE_TIMINGS_FILE = "stage_timings.json"
+SCHEDULE_FILE = "schedule.json"
+ARTIFACTS_DIR = "artifacts"
+UPLOAD_SLOTS = {"long_videos": LONG_VIDEO_UPLOAD_TIME_UTC, "shorts": SHORTS_UPLOAD_TIME_UTC}
+DEFAULT_STAGE_SECONDS = {
+    "trends": 30,
+    "llm": 90,
+    "voiceover": 900,
+    "background": 60,
+    "render": 900,
+    "short": 120,
+    "thumbnail": 20
+}
+SCHEDULE_SAFETY_FACTOR = 1.5
+SCHEDULE_MARGIN = timedelta(minutes=15)
+UPLOAD_WINDOW = timedelta(hours=2)  # بعد از این مدت، اسلات از دست رفته حساب می‌شود
+SCHEDULER_POLL_SECONDS = 60
+
+_stage_timings_lock = threading.Lock()
+
+def record_stage_duration(stage, seconds, alpha=0.3):
+    """ ذخیره‌ی میانگین متحرک نمایی (EWMA) مدت هر مرحله """
+    with _stage_timings_lock:
+        timings = _read_json_file(STAGE_TIMINGS_FILE, {})
+        previous = timings.get(stage)
+        timings[stage] = seconds if previous is None else (1 - alpha) * previous + alpha * seconds
+        _write_json_atomic(STAGE_TIMINGS_FILE, timings)
+
+@contextmanager
+def timed_stage(stage):
+    started = monotonic()
+    yield
+    record_stage_duration(stage, monotonic() - started)
+
+def estimate_production_seconds():
+    timings = _read_json_file(STAGE_TIMINGS_FILE, {})
+    return sum(timings.get(stage, default) for stage, default in DEFAULT_STAGE_SECONDS.items())
+
+def _stage_llm(job):
+    # 4️⃣ تولید متن ویدیو و متادیتای بررسی‌شده با LLM (در حالت streaming، صداگذاری هم همین‌جا انجام می‌شود)
+    with timed_stage("llm"):
+        package = stream_script_to_voiceover(job["topic"]) if LLM_STREAM else generate_video_package(job["topic"])
+    if not package:
+        return False
+
+    job["script"] = package["script"]
+    job["metadata"] = package["metadata"]
+    if "voiceover" in package:
+        enhance_audio(package["voiceover"])
+        job["voiceover"] = package["voiceover"]
+        job["segments"] = package["segments"]
+    return True
+
+def _stage_voiceover(job):
+    if "voiceover" in job:
+        return True  # قبلاً همزمان با تولید متن ساخته شده است
+
+    # 5️⃣ تولید صداگذاری از روی متن (در حافظه، بدون فایل WAV)
+    with timed_stage("voiceover"):
+        voiceover, job["segments"] = synthesize_voiceover(job["script"])
+    if voiceover is None:
+        print("❌ Voiceover generation failed. Skipping video creation.")
+        return False
+
+    # حذف نویز و بهینه‌سازی صدا به صورت درجا روی همان بافر
+    enhance_audio(voiceover)
+    job["voiceover"] = voiceover
+    return True
+
+def _stage_background(job):
+    # 6️⃣ دریافت ویدیوی پس‌زمینه و تطبیق طول آن با صداگذاری
+    with timed_stage("background"):
+        background_video = download_best_minecraft_background() or "minecraft_parkour.mp4"
+        job["background"] = fit_background_to_duration(background_video, len(job["voiceover"]) / BARK_SAMPLE_RATE,
+                                                       f"{os.path.splitext(job['output_video'])[0]}_background.mp4")
+    if not job["background"]:
+        print("❌ Background preparation failed.")
+        return False
+    return True
+
+def _stage_deadline(job, *later_stages):
+    """ مهلت این مرحله: زمان اسلات آپلود منهای زمان تخمینی مراحل بعدی """
+    if not job.get("deadline"):
+        return None
+    timings = _read_json_file(STAGE_TIMINGS_FILE, {})
+    reserve = sum(timings.get(stage, DEFAULT_STAGE_SECONDS.get(stage, 0)) for stage in later_stages)
+    return job["deadline"] - timedelta(seconds=reserve)
+
+def _stage_render(job, threads=None):
+    # 7️⃣ رندر ویدیوی نهایی با عنوان‌ها، زیرنویس و افکت‌ها در یک encode
+    with timed_stage("render"):
+        ass_file = None
+        if SUBTITLES_ENABLED and job.get("segments"):
+            job["subtitles"], ass_file = generate_subtitles(job["voiceover"], job["segments"],
+                                                            f"{os.path.splitext(job['output_video'])[0]}.srt")
+        job["video"] = render_video(job["voiceover"], job["background"], job["output_video"], threads=threads,
+                                    subtitles_file=ass_file, deadline=_stage_deadline(job, "short", "thumbnail"))
+    if not job["video"]:
+        print("❌ Video generation failed.")
+        return False
+    return True
+
+def _stage_short(job, threads=None):
+    # 🎞 ساخت Short عمودی از همان صدا و پس‌زمینه (شکست آن جلوی ویدیوی بلند را نمی‌گیرد)
+    if not SHORTS_ENABLED:
+        return True
+
+    with timed_stage("short"):
+        job["short_video"] = render_short(job["voiceover"], job["background"], job.get("segments"),
+                                          f"{os.path.splitext(job['output_video'])[0]}_short.mp4", threads=threads,
+                                          deadline=_stage_deadline(job, "thumbnail"))
+    if not job["short_video"]:
+        print("⚠ Short rendering failed; continuing with the long video only.")
+    return True
+
+def _stage_thumbnail(job):
+    # 8️⃣ تولید تامبنیل برای ویدیو (شکست آن جلوی آپلود را نمی‌گیرد)
+    with timed_stage("thumbnail"):
+        job["thumbnail_variants"] = generate_thumbnail_variants(job["topic"], job["thumbnail_file"])
+        job["thumbnail"] = job["thumbnail_variants"][0] if job["thumbnail_variants"] else None
+    return True
+
+PRODUCTION_STAGES = [_stage_llm, _stage_voiceover, _stage_background, _stage_render, _stage_short, _stage_thumbnail]
+ARTIFACT_FIELDS = ["topic", "script", "segments", "video", "short_video", "background", "thumbnail",
+                   "thumbnail_variants", "metadata", "subtitles", "uploads"]
+
+def _new_job(topic, output_video, thumbnail_file, deadline=None):
+    return {"topic": topic, "output_video": output_video, "thumbnail_file": thumbnail_file, "deadline": deadline}
+
+def _job_artifact(job):
+    """ خروجی قابل ذخیره در JSON؛ بافر صدا کنار گذاشته می‌شود """
+    return {field: job.get(field) for field in ARTIFACT_FIELDS}
+
+def produce_video(topic=None, output_video="final_video.mp4", thumbnail_file="thumbnail.jpg", progress=None,
+                  deadline=None):
+    """
+    تولید کامل یک ویدیو بدون آپلود: ترند، متن، صدا، پس‌زمینه، رندر، تامبنیل و متادیتا.
+    خروجی یک dict از مسیر فایل‌ها و متادیتا است (یا None در صورت خطا).
+    progress در صورت وجود قبل از هر مرحله با (نام مرحله، شماره، تعداد کل) صدا زده می‌شود.
+    deadline (datetime با منطقه‌ی زمانی) زمانی است که ویدیو باید آماده باشد و preset encode را تعیین می‌کند.
+    """
+    selected_topic = topic
+    if not selected_topic:
+        # 2️⃣ دریافت و ذخیره‌ی ترندهای مختلف 
+        with timed_stage("trends"):
+            trends = fetch_all_trends()
 
-    # 1️⃣3️⃣ بررسی محدودیت‌های آپلود و انجام آن در زمان مناسب
-    upload_type = get_upload_type()
-    upload_limits = check_upload_limit()
-    
-    if upload_type and upload_limits[upload_type] < (MAX_LONG_UPLOADS if upload_type == "long_videos" else MAX_SHORTS_UPLOADS):
-        print(f"✅ It's time to upload a {upload_type.replace('_', ' ')}. Proceeding with upload.")
+        # 3️⃣ تحلیل داده‌های ترند و انتخاب بهترین موضوع
+        selected_topic = select_best_trending_topic(trends)
+        if not selected_topic:
+            print("⚠ No suitable topic found, skipping video creation.")
+            return None  # اگر موضوع مناسبی پیدا نشود، اجرا متوقف می‌شود.
+
+    print(f"🔥 Creating a video on: {selected_topic}")
+
+    job = _new_job(selected_topic, output_video, thumbnail_file, deadline)
+    for i, stage in enumerate(PRODUCTION_STAGES):
+        if progress:
+            progress(stage.__name__.removeprefix("_stage_"), i, len(PRODUCTION_STAGES))
+        if not stage(job):
+            return None
+    return _job_artifact(job)
+
+# تولید دسته‌ای: هر گروه از مراحل استخرِ کارگر خودش را دارد و صف‌های محدود بین آن‌ها فشار برگشتی ایجاد می‌کنند
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "3"))
+BATCH_QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "2"))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "4"))
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "4"))
+BATCH_VOICEOVER_JOBS = int(os.getenv("BATCH_VOICEOVER_JOBS", "2"))  # همه روی استخر پردازشی Bark مشترک
+RENDER_THREADS = int(os.getenv("RENDER_THREADS", "4"))
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // RENDER_THREADS)
+
+_BATCH_DONE = object()
+
+def _batch_stage_group(name, stages, inbox, outbox, failures):
+    """ یک کارگر: کار را از inbox می‌گیرد، مراحل را اجرا می‌کند و نتیجه را به outbox می‌فرستد """
+    while True:
+        job = inbox.get()
+        if job is _BATCH_DONE:
+            inbox.put(_BATCH_DONE)  # برای بقیه‌ی کارگرهای همین گروه
+            return
 
         try:
-            video_file = LONG_VIDEO_FILE if upload_type == "long_videos" else SHORT_VIDEO_FILE
-            category_id = 20  # دسته‌بندی Gaming
-            video_id = upload_metadata(title, description, category_id, "public")
-            
-            if video_id:
-                upload_video(video_file, video_id)
-                log_upload(upload_type)  # ثبت آپلود در لاگ
+            ok = all(stage(job) for stage in stages)
         except Exception as e:
-            print("❌ An error occurred:", str(e))
+            print(f"❌ Batch stage '{name}' crashed for '{job['topic']}': {e}")
+            ok = False
+
+        if ok:
+            outbox.put(job)
+        else:
+            failures.append(job["topic"])
+
+def _stage_upload(job):
+    """
+    آپلود ویدیوی بلند و Short آن، هر کدام در سهمیه‌ی روزانه‌ی خودش. رسیدن به سقف روزانه خطا نیست:
+    نتیجه روی job ثبت می‌شود و ویدیوی تولیدشده در خروجی batch باقی می‌ماند.
+    """
+    artifact = _job_artifact(job)
+    job["uploads"] = {}
+    for upload_type, field in [("long_videos", "video"), ("shorts", "short_video")]:
+        if not artifact.get(field):
+            continue
+        uploaded = publish_video(artifact, upload_type)
+        job["uploads"][upload_type] = uploaded.get("id") if uploaded else None
+    return True
+
+def run_batch(topics=None, count=BATCH_SIZE, upload=False):
+    """
+    تولید چند ویدیو به صورت خط لوله: وقتی ویدیوی اول در حال رندر است، صدای دومی و متن سومی ساخته می‌شود.
+    مراحل LLM و HTTP روی thread pool اجرا می‌شوند؛ Bark روی استخر پردازشی مشترک و
+    رندر روی RENDER_WORKERS پردازه‌ی ffmpeg (هر کدام RENDER_THREADS رشته).
+    """
+    if not topics:
+        with timed_stage("trends"):
+            trends = fetch_all_trends()
+        topics = select_trending_topics(trends, count)
+    if not topics:
+        print("⚠ No suitable topics found, skipping batch.")
+        return []
+
+    print(f"🏭 Starting a batch of {len(topics)} videos...")
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+
+    render = lambda job: _stage_render(job, threads=RENDER_THREADS)
+    short = lambda job: _stage_short(job, threads=RENDER_THREADS)
+    groups = [
+        ("llm", [_stage_llm], LLM_WORKERS),
+        ("voiceover", [_stage_voiceover], BATCH_VOICEOVER_JOBS),
+        ("background", [_stage_background], HTTP_WORKERS),
+        ("render", [render, short], RENDER_WORKERS),
+        ("thumbnail", [_stage_thumbnail], HTTP_WORKERS)
+    ]
+    if upload:
+        groups.append(("upload", [_stage_upload], 1))
+
+    # صف ورودی بی‌حد است تا همه‌ی موضوع‌ها بدون بلاک شدن ثبت شوند؛ صف‌های میانی محدودند
+    queues = [queue.Queue()] + [queue.Queue(maxsize=BATCH_QUEUE_SIZE) for _ in groups[1:]] + [queue.Queue()]
+    failures = []
+    pools = []
+
+    for i, (name, stages, workers) in enumerate(groups):
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"batch-{name}")
+        futures = [pool.submit(_batch_stage_group, name, stages, queues[i], queues[i + 1], failures)
+                   for _ in range(workers)]
+        pools.append((pool, futures))
+
+    for i, topic in enumerate(topics):
+        queues[0].put(_new_job(topic, os.path.join(ARTIFACTS_DIR, f"batch_{stamp}_{i}.mp4"),
+                               os.path.join(ARTIFACTS_DIR, f"batch_{stamp}_{i}.jpg")))
+    queues[0].put(_BATCH_DONE)
+
+    # خاموشی مرحله به مرحله: وقتی همه‌ی کارگرهای یک گروه تمام شدند، پایان به گروه بعدی اعلام می‌شود
+    for i, (pool, futures) in enumerate(pools):
+        for future in futures:
+            future.result()
+        pool.shutdown()
+        queues[i + 1].put(_BATCH_DONE)
+
+    artifacts = []
+    while True:
+        job = queues[-1].get()
+        if job is _BATCH_DONE:
+            break
+        artifacts.append(_job_artifact(job))
+
+    print(f"✅ Batch finished: {len(artifacts)} produced, {len(failures)} failed.")
+    for topic in failures:
+        print(f"⚠ Failed topic: {topic}")
+    return artifacts
+
+def publish_video(artifact, upload_type):
+    """ آپلود یک ویدیوی آماده (در صورت مجاز بودن سقف روزانه) و ثبت آن در دفتر آپلودها """
+    upload_limits = check_upload_limit()
+    if upload_limits[upload_type] >= (MAX_LONG_UPLOADS if upload_type == "long_videos" else MAX_SHORTS_UPLOADS):
+        print(f"⏳ Today's {upload_type.replace('_', ' ')} upload limit has been reached.")
+        return None
+
+    title = artifact["metadata"]["title"]
+    description = artifact["metadata"]["description"]
+
+    try:
+        video_file = artifact["video"] if upload_type == "long_videos" else artifact.get("short_video", SHORT_VIDEO_FILE)
+        category_id = 20  # دسته‌بندی Gaming
+
+        # متادیتا همراه نشست آپلود ارسال می‌شود؛ یک videos.insert به جای دو تا
+        uploaded = upload_video(video_file, metadata=build_video_resource(title, description, category_id, "public"))
+        if uploaded:
+            log_upload(upload_type, uploaded.get("id"), title)  # ثبت آپلود در لاگ
+        return uploaded
+    except Exception as e:
+        print("❌ An error occurred:", str(e))
+        return None
+
+def run_pipeline():
+    """ اجرای کامل خط تولید: ترند، متن، صدا، ویدیو، متادیتا و آپلود """
+    print("🚀 Starting the YouTube Auto-Upload Bot...")
+
+    # 1️⃣ تحلیل ویدیوهای قبلی و ارائه پیشنهادات برای بهینه‌سازی
+    suggest_improvements()
+
+    artifact = produce_video()
+    if not artifact:
+        return None
+
+    # 1️⃣1️⃣ بررسی محدودیت‌های آپلود (از دفتر محلی، بدون مصرف سهمیه) و آپلود در زمان مناسب
+    upload_type = get_upload_type()
+    if upload_type:
+        print(f"✅ It's time to upload a {upload_type.replace('_', ' ')}. Proceeding with upload.")
+        publish_video(artifact, upload_type)
     else:
         print("⏳ Either it's not the right time for upload or today's upload limit has been reached.")
+
+    print(f"📊 YouTube quota used today: {get_quota_usage()['used']}/{YOUTUBE_DAILY_QUOTA}")
+
+    return artifact["video"]
+
+def next_upload_slot(upload_type, now=None):
+    """ اسلات آپلود بعدی (UTC)؛ اسلاتی که هنوز در پنجره‌ی آپلود است، اسلات فعلی حساب می‌شود """
+    now = now or datetime.now(timezone.utc)
+    slot = datetime.combine(now.date(), UPLOAD_SLOTS[upload_type], tzinfo=timezone.utc)
+    if slot + UPLOAD_WINDOW < now:
+        slot += timedelta(days=1)
+    return slot
+
+def plan_render_start(slot):
+    """ زمان شروع تولید: از اسلات به عقب، بر اساس مدت اندازه‌گیری‌شده‌ی مراحل """
+    return slot - timedelta(seconds=estimate_production_seconds() * SCHEDULE_SAFETY_FACTOR) - SCHEDULE_MARGIN
+
+def _load_schedule():
+    schedule = _read_json_file(SCHEDULE_FILE, {"jobs": {}})
+    for job in schedule["jobs"].values():
+        # کاری که هنگام توقف برنامه در حال تولید بود، دوباره شروع می‌شود
+        if job["status"] == "producing":
+            job["status"] = "planned"
+    return schedule
+
+def _reusable_short(schedule):
+    """ کار ویدیوی بلندی که Short آن ساخته شده ولی هنوز برای اسلات Shorts استفاده نشده است """
+    for job in schedule["jobs"].values():
+        artifact = job.get("artifact") or {}
+        if job["upload_type"] != "long_videos" or job.get("short_used"):
+            continue
+        if artifact.get("short_video") and os.path.isfile(artifact["short_video"]):
+            return job
+    return None
+
+def run_scheduler(poll_seconds=SCHEDULER_POLL_SECONDS, once=False):
+    """
+    زمان‌بند دائمی: برای هر اسلات آپلود، تولید را آن‌قدر زودتر شروع می‌کند که وقتی پنجره‌ی
+    آپلود باز می‌شود، ویدیوی آماده منتظر باشد. وضعیت در SCHEDULE_FILE ذخیره می‌شود.
+    """
+    print("🗓 Starting the upload scheduler...")
+    schedule = _load_schedule()
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+
+    while True:
+        now = datetime.now(timezone.utc)
+        wake_times = []
+
+        for upload_type in UPLOAD_SLOTS:
+            slot = next_upload_slot(upload_type, now)
+            key = f"{upload_type}@{slot.isoformat()}"
+            job = schedule["jobs"].setdefault(key, {"upload_type": upload_type, "slot": slot.isoformat(), "status": "planned"})
+            start_at = plan_render_start(slot)
+            job["start_at"] = start_at.isoformat()
+
+            reusable = _reusable_short(schedule) if upload_type == "shorts" else None
+            if job["status"] == "planned" and reusable:
+                # Short از تولید ویدیوی بلند قبلی آماده است؛ تولید دوباره لازم نیست
+                print(f"♻ Reusing the Short rendered with {reusable['artifact']['video']} for the {slot:%Y-%m-%d %H:%M} UTC slot.")
+                reusable["short_used"] = True
+                job["status"] = "ready"
+                job["artifact"] = reusable["artifact"]
+
+            if job["status"] == "planned" and now >= start_at:
+                print(f"🏭 Producing {upload_type.replace('_', ' ')} for the {slot:%Y-%m-%d %H:%M} UTC slot...")
+                job["status"] = "producing"
+                _write_json_atomic(SCHEDULE_FILE, schedule)
+
+                stamp = slot.strftime("%Y%m%d_%H%M")
+                artifact = produce_video(output_video=os.path.join(ARTIFACTS_DIR, f"{upload_type}_{stamp}.mp4"),
+                                         thumbnail_file=os.path.join(ARTIFACTS_DIR, f"{upload_type}_{stamp}.jpg"),
+                                         deadline=slot)
+                job["status"] = "ready" if artifact else "failed"
+                job["artifact"] = artifact
+                now = datetime.now(timezone.utc)
+                if artifact and now > slot:
+                    print(f"⚠ Production finished {int((now - slot).total_seconds())}s after the slot opened.")
+
+            if job["status"] == "ready" and now >= slot:
+                uploaded = publish_video(job["artifact"], upload_type)
+                job["status"] = "uploaded" if uploaded else "upload_failed"
+
+            if job["status"] == "planned":
+                wake_times.append(start_at)
+            elif job["status"] == "ready":
+                wake_times.append(slot)
+
+        # کارهای قدیمی‌تر از دو روز از فایل وضعیت حذف می‌شوند
+        cutoff = now - timedelta(days=2)
+        schedule["jobs"] = {k: j for k, j in schedule["jobs"].items() if datetime.fromisoformat(j["slot"]) >= cutoff}
+        _write_json_atomic(SCHEDULE_FILE, schedule)
+
+        if once:
+            return schedule
+
+        next_wake = min(wake_times, default=now + timedelta(seconds=poll_seconds))
+        sleep(min(poll_seconds, max(1.0, (next_wake - datetime.now(timezone.utc)).total_seconds())))
+
+# سرویس HTTP برای gunicorn (Procfile: gunicorn YT:app)؛ رندرها در پس‌زمینه اجرا می‌شوند و درخواست‌ها بلاک نمی‌شوند
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")  # وضعیت هر کار روی دیسک تا همه‌ی workerهای gunicorn آن را ببینند
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOBS_API_TOKEN = os.getenv("JOBS_API_TOKEN")  # بدون آن POST /jobs غیرفعال است
+JOB_ARTIFACTS = {"video": "video", "thumbnail": "thumbnail", "short": "short_video"}
+
+app = Flask(__name__)
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def _get_job_executor():
+    """ executor مشترک کارها؛ در اولین استفاده مدل‌های Bark را هم در پس‌زمینه گرم می‌کند """
+    global _job_executor
+
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+            threading.Thread(target=warm_voiceover_pool, daemon=True).start()
+        return _job_executor
+
+def _job_file(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _load_job(job_id):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    return _read_json_file(_job_file(job_id), None)
+
+def _update_job(job_id, **fields):
+    job = _read_json_file(_job_file(job_id), {})
+    job.update(fields, updated_at=datetime.now(timezone.utc).isoformat())
+    _write_json_atomic(_job_file(job_id), job)
+    return job
+
+def _run_job(job_id, topic, upload):
+    _update_job(job_id, status="running")
+
+    def report(stage, index, total):
+        _update_job(job_id, stage=stage, progress=round(index / total, 2))
+
+    try:
+        artifact = produce_video(topic, output_video=os.path.join(ARTIFACTS_DIR, f"job_{job_id}.mp4"),
+                                 thumbnail_file=os.path.join(ARTIFACTS_DIR, f"job_{job_id}.jpg"), progress=report)
+        if not artifact:
+            _update_job(job_id, status="failed", error="Production failed; see server logs.")
+            return
+
+        _update_job(job_id, status="ready", stage=None, progress=1.0, artifact=artifact)
+        if upload:
+            uploaded = publish_video(artifact, "long_videos")
+            _update_job(job_id, status="uploaded" if uploaded else "upload_failed",
+                        video_id=uploaded.get("id") if uploaded else None)
+    except Exception as e:
+        print(f"❌ Job {job_id} crashed: {e}")
+        _update_job(job_id, status="failed", error=str(e))
+
+@app.before_request
+def _check_api_token():
+    # بدون توکن، سرویس فقط‌خواندنی است: ساختن کار (و آپلود روی کانال) هرگز بدون احراز هویت ممکن نیست
+    if not JOBS_API_TOKEN:
+        if request.method not in ("GET", "HEAD"):
+            return jsonify({"error": "job submission is disabled until JOBS_API_TOKEN is set"}), 403
+        return None
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {JOBS_API_TOKEN}"):
+        return jsonify({"error": "unauthorized"}), 401
+
+@app.post("/jobs")
+def create_job():
+    payload = request.get_json(silent=True) or {}
+    topic = payload.get("topic")
+    if topic is not None and (not isinstance(topic, str) or not topic.strip()):
+        return jsonify({"error": "topic must be a non-empty string"}), 400
+
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    job_id = os.urandom(16).hex()
+    job = _update_job(job_id, id=job_id, topic=topic, status="queued", stage=None, progress=0.0,
+                      created_at=datetime.now(timezone.utc).isoformat())
+    _get_job_executor().submit(_run_job, job_id, topic, bool(payload.get("upload")))
+    return jsonify(job), 202
+
+@app.get("/jobs")
+def list_jobs():
+    if not os.path.isdir(JOBS_DIR):
+        return jsonify([])
+    jobs = [_read_json_file(os.path.join(JOBS_DIR, name), None) for name in os.listdir(JOBS_DIR) if name.endswith(".json")]
+    return jsonify(sorted((j for j in jobs if j), key=lambda j: j.get("created_at", ""), reverse=True))
+
+@app.get("/jobs/<job_id>")
+def get_job(job_id):
+    job = _load_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+@app.get("/jobs/<job_id>/artifacts/<name>")
+def download_job_artifact(job_id, name):
+    job = _load_job(job_id)
+    if job is None or name not in JOB_ARTIFACTS:
+        return jsonify({"error": "artifact not found"}), 404
+
+    path = (job.get("artifact") or {}).get(JOB_ARTIFACTS[name])
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "artifact not ready", "status": job.get("status")}), 409
+    return send_file(os.path.abspath(path), as_attachment=True)
+
+# اجرای آپلود در زمان مناسب
+if __name__ == "__main__":
+    if "--schedule" in sys.argv:
+        run_scheduler()
+    elif "--batch" in sys.argv:
+        index = sys.argv.index("--batch")
+        count = int(sys.argv[index + 1]) if len(sys.argv) > index + 1 and sys.argv[index + 1].isdigit() else BATCH_SIZE
+        run_batch(count=count, upload="--upload" in sys.argv)
+    else:
+        run_pipeline()